@@ -16,9 +16,8 @@ def get_position(entity, memory):
     """
     Return the position of [entity] according to memory.
     """
-    for pct in memory.of_class(PositionPrecept):
-        if pct.entity is entity:
-            return pct.position
+    for pct in memory.about(entity):
+        return pct.position
 
 
 class LookAction(CalledOnceContext):
@@ -27,7 +26,19 @@ class LookAction(CalledOnceContext):
 
 
 class MoveAction(ActionContext):
+    # if true, follow the environment's flow field to the endpoint instead
+    # of a path, so agents going to the same place share the search
+    use_flow_field = False
+
+    # cost of a move to an endpoint that has no path
+    unreachable_cost = 1000000
+
     def enter(self):
+        self.field = None
+        if self.use_flow_field:
+            self.field = self.parent.environment.flow_field(self.endpoint)
+            return
+
         self.path = self.parent.environment.pathfind(self.startpoint,
                     self.endpoint)
 
@@ -35,20 +46,65 @@ class MoveAction(ActionContext):
         self.path.pop()
 
     def update(self, time):
+        if self.field is not None:
+            self.follow_field()
+            return
+
         if self.path:
             pos = self.path.pop()
             self.parent.environment.set_position(self.parent,
                     (self.parent.environment, pos))
 
         if not self.path:
+            # remember where we are now
+            self.touch()
             self.finish()
 
+    def follow_field(self):
+        env = self.parent.environment
+        here = env.get_position(self.parent)[1]
+        pos = self.field.next(here)
+
+        if pos is None:
+            if self.field.distance(here) is None:
+                # the endpoint can't be reached from here
+                self.fail()
+                return
+        else:
+            env.set_position(self.parent, (env, pos))
+            if self.field.distance(pos) > 0:
+                return
+
+        # remember where we are now
+        self.touch()
+        self.finish()
+
     def setStartpoint(self, pos):
         self.startpoint = pos
  
     def setEndpoint(self, pos):
         self.endpoint = pos
 
+    def path_cost(self, memory):
+        """
+        cost of walking the path, one for each step, or unreachable_cost
+        if there is no path
+        """
+        if self.startpoint is None:
+            return 1
+
+        path = self.parent.environment.pathfind(self.startpoint,
+                    self.endpoint)
+
+        if not path:
+            return self.unreachable_cost
+
+        return max(len(path) - 1, 1)
+
+    def cost_key(self):
+        # the path only depends on the start and end points
+        return (self.__class__, self.startpoint, self.endpoint)
+
 
 class PickupAction(CalledOnceContext):
     """
@@ -79,6 +135,9 @@ class move_to_entity(ActionBuilder):
     return a list of action that this caller is able to move with
     """
 
+    reads = (PositionPrecept,)
+    produces = (PositionPrecept,)
+
     def get_actions(self, caller, memory):
         here = get_position(caller, memory)
         visited = []
@@ -87,11 +146,21 @@ class move_to_entity(ActionBuilder):
             if pct.entity is caller or pct.position in visited:
                 continue
 
+            # things in an inventory are not somewhere to move to
+            if pct.position[0] == 'self':
+                continue
+
             visited.append(pct.position)
 
             action = MoveAction(caller)
             action.setStartpoint(here)
             action.setEndpoint(pct.position[1])
+
+            cost = action.path_cost(memory)
+            if cost >= action.unreachable_cost:
+                continue
+
+            action.costs['distance'] = cost
             action.effects.append(PositionGoal(caller, pct.position))
             yield action
 
@@ -99,17 +168,22 @@ exported_actions.append(move_to_entity)
 
 
 class pickup(ActionBuilder):
+    reads = (PositionPrecept,)
+    produces = (PositionPrecept,)
+
     def get_actions(self, caller, memory):
         """
-        return list of actions that will pickup an item at caller's position
+        return list of actions that will pickup an item
+        the caller must be at the item's position
         """
-        here = get_position(caller, memory) 
-
         for pct in memory.of_class(PositionPrecept):
-            if here == pct.position and pct.entity is not caller:
-                action = PickupAction(caller)
-                action.effects.append(HasItemGoal(pct.entity))
-                yield action
+            if pct.entity is caller or pct.position[0] == 'self':
+                continue
+
+            action = PickupAction(caller)
+            action.prereqs.append(PositionGoal(caller, pct.position))
+            action.effects.append(HasItemGoal(pct.entity))
+            yield action
 
 exported_actions.append(pickup)
 
@@ -118,11 +192,22 @@ class drink_rum(ActionBuilder):
     """
     drink rum that is in caller's inventory
     """
+
+    reads = (PositionPrecept,)
+    produces = ('is_drunk',)
+
     def get_actions(self, caller, memory):
+        visited = []
+
         for pct in memory.of_class(PositionPrecept):
             #print "looking for rum", pct
-            if pct.position[0] == 'self' and pct.entity.name == "rum":
+            if pct.entity in visited or pct.entity is caller:
+                continue
+
+            if pct.entity.name == "rum":
+                visited.append(pct.entity)
                 action = DrinkRumAction(caller)
+                action.prereqs.append(HasItemGoal(pct.entity))
                 action.effects.append(SimpleGoal(is_drunk=True))
                 #action.effects.append(EvalGoal("charisma = charisma + 10"))
                 yield action
@@ -132,6 +217,9 @@ exported_actions.append(drink_rum)
 
 
 class look(ActionBuilder):
+    reads = ()
+    produces = ('aware',)
+
     def get_actions(self, caller, memory):
         action = LookAction(caller)
         action.effects.append(SimpleGoal(aware=True))
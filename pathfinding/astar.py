@@ -1,5 +1,11 @@
 from heapq import heappush, heappop, heappushpop, heapify
 from collections import defaultdict
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Astar(object):
     pass
@@ -120,6 +126,405 @@ def search(start, finish, factory):
     return []
 
 
+# moves to the surrounding cells, as (dx, dy, cost).  the costs are the same
+# as dist(), so grids and factories find paths of the same length.
+gridMoves = ((-1, -1, 2), (0, -1, 1), (1, -1, 2),
+             (-1,  0, 1),             (1,  0, 1),
+             (-1,  1, 2), (0,  1, 1), (1,  1, 2))
+
+
+class Grid(object):
+    """
+    A map for searching where every cell is either passable or not.
+
+    Passability is a flat sequence indexed by y * width + x, where anything
+    true is passable.  It can be a list, an array, a bytearray, or a NumPy
+    array of any shape, and is copied into a bytearray.
+
+    The costs, parents and closed cells of a search are kept in arrays that
+    are allocated once for the grid, so a search does not create an object
+    for every cell that it visits.  Each search has its own id, and values
+    from other searches are ignored, so the arrays never have to be reset.
+    """
+
+    def __init__(self, width, height, passable=None):
+        self.width = width
+        self.height = height
+        size = width * height
+
+        if passable is None:
+            self.passable = bytearray('\x01') * size
+        elif numpy is not None and isinstance(passable, numpy.ndarray):
+            flat = (numpy.asarray(passable).ravel() != 0).astype(numpy.uint8)
+            self.passable = bytearray(flat.tostring())
+        else:
+            self.passable = bytearray(1 if i else 0 for i in passable)
+
+        if len(self.passable) != size:
+            raise ValueError("passability must have width * height cells")
+
+        # changed whenever passability changes
+        self.version = 0
+
+        self._g = array('l', [0]) * size
+        self._parent = array('l', [-1]) * size
+        self._seen = array('L', [0]) * size
+        self._closed = array('L', [0]) * size
+        self._search = 0
+        self._shift = (size * 2).bit_length()
+
+    @classmethod
+    def from_rows(cls, rows, passable=lambda value: not value):
+        """
+        Make a grid from a list of rows, such as the data of a TMX layer.
+        by default, empty cells are passable.
+        """
+        height = len(rows)
+        width = len(rows[0]) if rows else 0
+        cells = [ passable(value) for row in rows for value in row ]
+        return cls(width, height, cells)
+
+    def is_passable(self, (x, y)):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.passable[y * self.width + x] == 1
+        return False
+
+    def set_passable(self, (x, y), value):
+        self.passable[y * self.width + x] = 1 if value else 0
+        self.version += 1
+
+    def search(self, start, finish, bounds=None):
+        """
+        Return a path like search() does, from finish back to start, or an
+        empty list if there is no path.
+
+        bounds is a rectangle (x0, y0, x1, y1), including its edges, that
+        the path must stay in.  by default, it is the whole grid.
+        """
+
+        width = self.width
+        if bounds is None:
+            x0, y0, x1, y1 = 0, 0, width - 1, self.height - 1
+        else:
+            x0, y0, x1, y1 = bounds
+        sx, sy = start
+        fx, fy = finish
+
+        if not (self.is_passable(start) and self.is_passable(finish)):
+            return []
+
+        self._search += 1
+        sid = self._search
+        g = self._g
+        parent = self._parent
+        seen = self._seen
+        closed = self._closed
+        passable = self.passable
+
+        begin = sy * width + sx
+        end = fy * width + fx
+        g[begin] = 0
+        parent[begin] = -1
+        seen[begin] = sid
+
+        # ties in f are broken by the highest g, so paths are followed to
+        # the end before others that are just as good are tried
+        shift = self._shift
+        openlist = [((abs(fx - sx) + abs(fy - sy)) << shift, begin)]
+
+        while openlist:
+            f, i = heappop(openlist)
+
+            # cells can be in the heap more than once.  the first time they
+            # are popped has the lowest cost, the rest are skipped.
+            if closed[i] == sid:
+                continue
+
+            if i == end:
+                path = []
+                while i != -1:
+                    path.append((i % width, i // width))
+                    i = parent[i]
+                return path
+
+            closed[i] = sid
+            y, x = divmod(i, width)
+            gi = g[i]
+
+            for dx, dy, cost in gridMoves:
+                nx = x + dx
+                ny = y + dy
+                if nx < x0 or ny < y0 or nx > x1 or ny > y1:
+                    continue
+
+                j = i + dy * width + dx
+                if not passable[j] or closed[j] == sid:
+                    continue
+
+                score = gi + cost
+                if seen[j] != sid or score < g[j]:
+                    seen[j] = sid
+                    g[j] = score
+                    parent[j] = i
+                    f = score + abs(fx - nx) + abs(fy - ny)
+                    heappush(openlist, ((f << shift) - score, j))
+
+        return []
+
+
+class JumpGrid(Grid):
+    """
+    A Grid that is searched with Jump Point Search.
+
+    On open maps, most of the paths that A* considers are the same path
+    with the moves in another order.  Jump Point Search only expands the
+    cells where a path has to turn because of a wall (jump points), and
+    skips over the others in straight or diagonal lines, so far fewer
+    cells are expanded.  The paths found cost the same as the ones found
+    by Grid, and include every cell, not just the jump points.  Of the
+    paths that cost the same, the one with the fewest steps is found, so
+    it can have fewer steps than Grid's path.
+
+    How far a straight move can go before it reaches a jump point or a wall
+    is worked out ahead of time for every cell, so that straight jumps do
+    not have to look at every cell on the way.  When passability changes,
+    only the rows and columns next to the cell are worked out again.
+    """
+
+    # (dx, dy) of the straight directions, in the order of the tables
+    straight = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+    def __init__(self, width, height, passable=None):
+        super(JumpGrid, self).__init__(width, height, passable)
+
+        # for each straight direction and cell, the distance to the next
+        # jump point, or minus the number of free cells before a wall
+        size = width * height
+        self._tables = [ array('l', [0]) * size for i in self.straight ]
+        for y in xrange(height):
+            self._update_row(y)
+        for x in xrange(width):
+            self._update_column(x)
+
+    def set_passable(self, (x, y), value):
+        super(JumpGrid, self).set_passable((x, y), value)
+        for row in (y - 1, y, y + 1):
+            if 0 <= row < self.height:
+                self._update_row(row)
+        for column in (x - 1, x, x + 1):
+            if 0 <= column < self.width:
+                self._update_column(column)
+
+    def free(self, x, y):
+        return (0 <= x < self.width and 0 <= y < self.height and
+                self.passable[y * self.width + x] == 1)
+
+    def _update_line(self, table, cells, forced):
+        # cells are the indexes of a line, in the order that they are
+        # moved through.  the line is worked out from its end.
+        passable = self.passable
+        previous = 0
+        for n in xrange(len(cells) - 1, -1, -1):
+            if n + 1 == len(cells) or not passable[cells[n + 1]]:
+                value = 0
+            elif forced(n + 1):
+                value = 1
+            elif previous > 0:
+                value = previous + 1
+            else:
+                value = previous - 1
+            table[cells[n]] = value
+            previous = value
+
+    def _update_row(self, y):
+        width = self.width
+        free = self.free
+        cells = range(y * width, (y + 1) * width)
+        for table, dx in ((self._tables[0], 1), (self._tables[1], -1)):
+            line = cells if dx > 0 else cells[::-1]
+            xs = range(width) if dx > 0 else range(width - 1, -1, -1)
+
+            def forced(n):
+                x = xs[n]
+                return ((not free(x, y + 1) and free(x + dx, y + 1)) or
+                        (not free(x, y - 1) and free(x + dx, y - 1)))
+
+            self._update_line(table, line, forced)
+
+    def _update_column(self, x):
+        width = self.width
+        free = self.free
+        cells = range(x, width * self.height, width)
+        for table, dy in ((self._tables[2], 1), (self._tables[3], -1)):
+            line = cells if dy > 0 else cells[::-1]
+            ys = range(self.height) if dy > 0 else \
+                 range(self.height - 1, -1, -1)
+
+            def forced(n):
+                y = ys[n]
+                return ((not free(x + 1, y) and free(x + 1, y + dy)) or
+                        (not free(x - 1, y) and free(x - 1, y + dy)))
+
+            self._update_line(table, line, forced)
+
+    def jump_straight(self, x, y, dx, dy, finish):
+        """
+        Return the jump point found moving straight from (x, y), or None.
+        """
+        table = self._tables[self.straight.index((dx, dy))]
+        value = table[y * self.width + x]
+        steps = value if value > 0 else -value
+
+        # the finish is a jump point too
+        fx, fy = finish
+        if dx:
+            if fy == y and 0 < (fx - x) * dx <= steps:
+                return finish
+            if value > 0:
+                return x + value * dx, y
+        else:
+            if fx == x and 0 < (fy - y) * dy <= steps:
+                return finish
+            if value > 0:
+                return x, y + value * dy
+        return None
+
+    def jump(self, x, y, dx, dy, finish):
+        """
+        Move from (x, y) in the direction (dx, dy) until a jump point is
+        found, and return it, or None if there isn't one.
+        """
+        if not (dx and dy):
+            return self.jump_straight(x, y, dx, dy, finish)
+
+        free = self.free
+        straight = self.jump_straight
+        while True:
+            x += dx
+            y += dy
+            if not free(x, y):
+                return None
+            if (x, y) == finish:
+                return x, y
+            if ((not free(x - dx, y) and free(x - dx, y + dy)) or
+                (not free(x, y - dy) and free(x + dx, y - dy))):
+                return x, y
+
+            # a diagonal move stops where a straight move finds something
+            if (straight(x, y, dx, 0, finish) is not None or
+                straight(x, y, 0, dy, finish) is not None):
+                return x, y
+
+    def directions(self, x, y, parent):
+        """
+        Return the directions to search from (x, y), reached from parent.
+        """
+        if parent is None:
+            return [ (dx, dy) for dx, dy, cost in gridMoves ]
+
+        px, py = parent
+        dx = (x > px) - (x < px)
+        dy = (y > py) - (y < py)
+        free = self.free
+
+        if dx and dy:
+            dirs = [(dx, 0), (0, dy), (dx, dy)]
+            if not free(x - dx, y):
+                dirs.append((-dx, dy))
+            if not free(x, y - dy):
+                dirs.append((dx, -dy))
+        elif dx:
+            dirs = [(dx, 0)]
+            if not free(x, y + 1):
+                dirs.append((dx, 1))
+            if not free(x, y - 1):
+                dirs.append((dx, -1))
+        else:
+            dirs = [(0, dy)]
+            if not free(x + 1, y):
+                dirs.append((1, dy))
+            if not free(x - 1, y):
+                dirs.append((-1, dy))
+
+        return dirs
+
+    def search(self, start, finish, bounds=None):
+        # the jump tables are for the whole grid
+        if bounds is not None:
+            return super(JumpGrid, self).search(start, finish, bounds)
+
+        start = tuple(start)
+        finish = tuple(finish)
+
+        if not (self.is_passable(start) and self.is_passable(finish)):
+            return []
+
+        # a diagonal move costs the same as the two straight moves it
+        # replaces, so there are many paths that are just as cheap.  of
+        # those, the one with the fewest steps is found, by keeping the
+        # number of steps with the cost and comparing them after it.
+        fx, fy = finish
+        sx, sy = start
+        parents = {start: None}
+        g = {start: (0, 0)}         # point -> (cost, steps)
+        closed = set()
+        openlist = [(abs(fx - sx) + abs(fy - sy),
+                     max(abs(fx - sx), abs(fy - sy)), 0, start)]
+
+        while openlist:
+            f, steps, score, point = heappop(openlist)
+            if point in closed:
+                continue
+
+            if point == finish:
+                return self.walk(point, parents)
+
+            closed.add(point)
+            x, y = point
+            cost, steps = g[point]
+
+            for dx, dy in self.directions(x, y, parents[point]):
+                found = self.jump(x, y, dx, dy, finish)
+                if found is None or found in closed:
+                    continue
+
+                # jumps are straight or diagonal, so the cost is the same
+                # as dist(), and the steps are the longest side
+                jx, jy = found
+                ax = abs(jx - x)
+                ay = abs(jy - y)
+                score = (cost + ax + ay, steps + max(ax, ay))
+                if found not in g or score < g[found]:
+                    g[found] = score
+                    parents[found] = point
+                    hx = abs(fx - jx)
+                    hy = abs(fy - jy)
+                    heappush(openlist, (score[0] + hx + hy,
+                        score[1] + max(hx, hy), -score[0], found))
+
+        return []
+
+    def walk(self, point, parents):
+        """
+        Return every cell between the jump points, from point back to the
+        start.
+        """
+        path = [point]
+        parent = parents[point]
+        while parent is not None:
+            x, y = point
+            px, py = parent
+            dx = (px > x) - (px < x)
+            dy = (py > y) - (py < y)
+            while (x, y) != parent:
+                x += dx
+                y += dy
+                path.append((x, y))
+            point = parent
+            parent = parents[point]
+        return path
+
+
 def search_test(tests=1000):
     area = [[0, 1, 0, 0, 0, 0, 0, 0, 0, 0],
             [0, 1, 0, 0, 0, 0, 0, 0, 0, 0],
@@ -0,0 +1,176 @@
+"""
+Flow fields for grids.
+
+When many agents are going to the same place, searching for a path for each
+of them repeats most of the same work.  A FlowField is made once for a goal,
+or a set of goals, and knows how far every cell is from the nearest goal.
+An agent anywhere on the map can then find its next step by looking at the
+cells next to it.
+
+The distances are found with Dijkstra's algorithm, from the goals outward.
+Moves cost 1 or 2, like Grid.search, so the paths are as short as the ones
+that it finds.
+"""
+
+from astar import gridMoves
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+
+# a diagonal move costs the same as the two straight moves it replaces, so
+# when there is a choice, fewer steps are taken by trying diagonals first
+steps = sorted(gridMoves, key=lambda move: -move[2])
+
+
+class FlowField(object):
+    """
+    The distance from every cell of a grid to the nearest goal.
+
+    grid is a Grid, or anything with the same width, height, passable and
+    version.  goals is a list of (x, y) points.  If max_distance is given,
+    cells that are farther away are not searched, and are treated as if they
+    can't reach a goal.
+
+    distances is a flat sequence indexed by y * width + x, like
+    Grid.passable.  Cells that can't reach a goal are -1.  It is a NumPy
+    array if NumPy is installed, otherwise an array.
+
+    The field is for the grid as it was when the field was made.  If the
+    grid has changed since then, stale is true.
+    """
+
+    def __init__(self, grid, goals, max_distance=None):
+        self.grid = grid
+        self.width = grid.width
+        self.height = grid.height
+        self.goals = tuple( tuple(i) for i in goals )
+        self.max_distance = max_distance
+        self.version = grid.version
+
+        distances = self.build()
+        if numpy is not None:
+            distances = numpy.array(distances, dtype=numpy.int32)
+        self.distances = distances
+
+    @property
+    def stale(self):
+        return self.version != self.grid.version
+
+    def build(self):
+        """
+        Return the distances as an array.
+        """
+
+        width = self.width
+        height = self.height
+        passable = self.grid.passable
+        limit = self.max_distance
+
+        distances = array('l', [-1]) * (width * height)
+
+        # since moves cost 1 or 2, the cells to visit can be kept in a list
+        # for each distance instead of a heap
+        buckets = [[]]
+        for x, y in self.goals:
+            if 0 <= x < width and 0 <= y < height:
+                i = y * width + x
+                if passable[i]:
+                    distances[i] = 0
+                    buckets[0].append(i)
+
+        d = 0
+        while d < len(buckets):
+            for i in buckets[d]:
+                # cells can be added more than once.  the first time has
+                # the lowest distance.
+                if distances[i] != d:
+                    continue
+
+                y, x = divmod(i, width)
+                for dx, dy, cost in gridMoves:
+                    nx = x + dx
+                    ny = y + dy
+                    if nx < 0 or ny < 0 or nx >= width or ny >= height:
+                        continue
+
+                    j = i + dy * width + dx
+                    if not passable[j]:
+                        continue
+
+                    score = d + cost
+                    if limit is not None and score > limit:
+                        continue
+
+                    if distances[j] == -1 or score < distances[j]:
+                        distances[j] = score
+                        while len(buckets) <= score:
+                            buckets.append([])
+                        buckets[score].append(j)
+
+            buckets[d] = None
+            d += 1
+
+        return distances
+
+    def distance(self, (x, y)):
+        """
+        Return the distance from the point to the nearest goal, or None if
+        it can't reach one.
+        """
+        if 0 <= x < self.width and 0 <= y < self.height:
+            d = self.distances[y * self.width + x]
+            if d >= 0:
+                return int(d)
+        return None
+
+    def next(self, (x, y)):
+        """
+        Return the next point to move to from (x, y) to get closer to a
+        goal, or None if it is a goal, or can't reach one.
+        """
+
+        width = self.width
+        height = self.height
+        if not (0 <= x < width and 0 <= y < height):
+            return None
+
+        distances = self.distances
+        i = y * width + x
+        d = distances[i]
+        if d <= 0:
+            return None
+
+        for dx, dy, cost in steps:
+            nx = x + dx
+            ny = y + dy
+            if nx < 0 or ny < 0 or nx >= width or ny >= height:
+                continue
+
+            j = i + dy * width + dx
+            if distances[j] >= 0 and distances[j] + cost == d:
+                return nx, ny
+
+        return None
+
+    def path(self, start):
+        """
+        Return a path like Grid.search does, from the nearest goal back to
+        start, or an empty list if there is no path.
+        """
+        point = tuple(start)
+        if self.distance(point) is None:
+            return []
+
+        path = [point]
+        point = self.next(point)
+        while point is not None:
+            path.append(point)
+            point = self.next(point)
+
+        path.reverse()
+        return path
@@ -0,0 +1,466 @@
+"""
+Hierarchical pathfinding (HPA*) for grids.
+
+Searching a big map one cell at a time is slow, and most of the cells that
+are searched are not on the path.  A HierarchicalGrid splits the map into
+square clusters, and finds the entrances between neighbouring clusters, and
+how far each entrance is from the others in the same cluster.  Together they
+make a small graph of the map, which is searched first.  The path through the
+graph is then refined into cells, one cluster at a time.
+
+The graph is made when the HierarchicalGrid is made.  When a cell changes,
+only the cluster that it is in and the entrances next to it are made again.
+"""
+
+from astar import Grid, gridMoves
+from heapq import heappush, heappop
+
+
+
+# entrances that are at least this wide have a transition at each end,
+# instead of one in the middle
+wide_entrance = 6
+
+
+def moves(grid, bounds):
+    """
+    Return the moves that can be made from each cell in bounds, without
+    leaving it.  Cells are numbered from 0 in the corner of bounds, and the
+    moves of each one are a list of (cell, cost).
+    """
+
+    width = grid.width
+    passable = grid.passable
+    x0, y0, x1, y1 = bounds
+    w = x1 - x0 + 1
+    h = y1 - y0 + 1
+
+    table = []
+    for y in xrange(h):
+        for x in xrange(w):
+            found = []
+            if passable[(y0 + y) * width + x0 + x]:
+                for dx, dy, cost in gridMoves:
+                    nx = x + dx
+                    ny = y + dy
+                    if 0 <= nx < w and 0 <= ny < h and \
+                        passable[(y0 + ny) * width + x0 + nx]:
+                        found.append((ny * w + nx, cost))
+            table.append(found)
+    return table
+
+
+def costs(table, bounds, start, targets):
+    """
+    Return the cost from start to each of the targets that can be reached
+    without leaving bounds, as a dict of (x, y) -> cost.  table is made by
+    moves() for the same bounds.
+
+    The costs are the same as the costs of Grid.search.
+    """
+
+    x0, y0, x1, y1 = bounds
+    w = x1 - x0 + 1
+
+    remaining = set( (y - y0) * w + x - x0 for x, y in targets )
+    found = {}
+
+    sx, sy = start
+    begin = (sy - y0) * w + sx - x0
+    best = [None] * len(table)
+    best[begin] = 0
+    closed = [False] * len(table)
+    openlist = [(0, begin)]
+
+    while openlist and remaining:
+        g, i = heappop(openlist)
+        if closed[i]:
+            continue
+
+        closed[i] = True
+        if i in remaining:
+            remaining.discard(i)
+            y, x = divmod(i, w)
+            found[(x + x0, y + y0)] = g
+
+        for j, cost in table[i]:
+            if closed[j]:
+                continue
+
+            score = g + cost
+            if best[j] is None or score < best[j]:
+                best[j] = score
+                heappush(openlist, (score, j))
+
+    return found
+
+
+def path_cost(path):
+    """
+    Return the cost of walking a path of cells.
+    """
+    total = 0
+    for (ax, ay), (bx, by) in zip(path, path[1:]):
+        total += abs(bx - ax) + abs(by - ay)
+    return total
+
+
+class HierarchicalGrid(object):
+    """
+    Searches a Grid with HPA*.
+
+    This can be used anywhere that a Grid can, such as XYEnvironment.grid.
+    Paths are found much faster on big maps.  A path is found whenever
+    Grid.search would find one, but it is not always the shortest: it can
+    be a few percent longer, because it crosses between clusters at the
+    entrances.
+
+    Change passability with set_passable() so the graph is kept up to date.
+    If the grid is changed directly, the whole graph is made again on the
+    next search.
+    """
+
+    def __init__(self, grid, cluster_size=16):
+        self.grid = grid
+        self.cluster_size = cluster_size
+        self.width = grid.width
+        self.height = grid.height
+        self.build()
+
+    @classmethod
+    def from_rows(cls, rows, cluster_size=16, **kwargs):
+        return cls(Grid.from_rows(rows, **kwargs), cluster_size)
+
+    def build(self):
+        """
+        Make the graph for the whole grid.
+        """
+        size = self.cluster_size
+        self.columns = (self.width + size - 1) // size
+        self.rows = (self.height + size - 1) // size
+
+        # the pairs of cells, one on each side, where a border can be
+        # crossed, and the cost of the move.  borders are (cx, cy, dx, dy),
+        # between the cluster (cx, cy) and (cx + dx, cy + dy).
+        self._borders = {}
+
+        # the number of pairs that each transition is in
+        self._entrances = {}        # cluster -> {(x, y): count}
+
+        # the edges between clusters, and inside each cluster
+        self._inter = {}            # (x, y) -> {(x, y): cost}
+        self._intra = {}            # cluster -> {(x, y): {(x, y): cost}}
+
+        # paths inside a cluster that have been refined
+        self._paths = {}            # cluster -> {(a, b): path}
+
+        for cx in xrange(self.columns):
+            for cy in xrange(self.rows):
+                self.build_border((cx, cy, 1, 0))
+                self.build_border((cx, cy, 0, 1))
+
+        for cx in xrange(self.columns):
+            for cy in xrange(self.rows):
+                self.build_cluster((cx, cy))
+
+        self._built = self.grid.version
+
+    @property
+    def version(self):
+        # changed whenever passability changes, like Grid.version
+        return self.grid.version
+
+    @property
+    def passable(self):
+        return self.grid.passable
+
+    def is_passable(self, point):
+        return self.grid.is_passable(point)
+
+    def set_passable(self, (x, y), value):
+        """
+        Change a cell, and update the part of the graph around it.
+        """
+        if self._built != self.grid.version:
+            self.grid.set_passable((x, y), value)
+            self.build()
+            return
+
+        self.grid.set_passable((x, y), value)
+        self._built = self.grid.version
+
+        # a transition can use any cell next to it, so the borders of the
+        # clusters around this one can change too
+        cx, cy = self.cluster((x, y))
+        changed = set([(cx, cy)])
+        for nx in (cx - 1, cx, cx + 1):
+            for ny in (cy - 1, cy, cy + 1):
+                changed.update(self.build_border((nx, ny, 1, 0)))
+                changed.update(self.build_border((nx, ny, 0, 1)))
+
+        [ self.build_cluster(cluster) for cluster in changed ]
+
+    def cluster(self, (x, y)):
+        return x // self.cluster_size, y // self.cluster_size
+
+    def bounds(self, (cx, cy)):
+        """
+        Return the rectangle of cells in a cluster, including the edges.
+        """
+        size = self.cluster_size
+        return (cx * size, cy * size,
+                min((cx + 1) * size, self.width) - 1,
+                min((cy + 1) * size, self.height) - 1)
+
+    def build_border(self, border):
+        """
+        Find the transitions across a border between two clusters, and
+        return the clusters whose transitions have changed.
+
+        Paths can cut corners, so a diagonal move can cross a border where
+        no straight move can.  Those are transitions too, and can cross
+        into the cluster that is diagonal to this one.
+        """
+        cx, cy, dx, dy = border
+        if not (0 <= cx < self.columns - dx and 0 <= cy < self.rows - dy):
+            return set()
+
+        # cells along the last row or column of the first cluster
+        x0, y0, x1, y1 = self.bounds((cx, cy))
+        if dx:
+            cells = [ (x1, y) for y in xrange(y0, y1 + 1) ]
+        else:
+            cells = [ (x, y1) for x in xrange(x0, x1 + 1) ]
+
+        # runs of cells that are passable on both sides
+        is_passable = self.grid.is_passable
+        runs = []
+        run = []
+        for x, y in cells:
+            if is_passable((x, y)) and is_passable((x + dx, y + dy)):
+                run.append((x, y))
+            elif run:
+                runs.append(run)
+                run = []
+        if run:
+            runs.append(run)
+
+        pairs = []
+        for run in runs:
+            if len(run) >= wide_entrance:
+                ends = (run[0], run[-1])
+            else:
+                ends = (run[len(run) // 2],)
+            for x, y in ends:
+                pairs.append(((x, y), (x + dx, y + dy), 1))
+
+        # diagonal moves where both straight moves are blocked.  if either
+        # is open, a straight transition already connects the two cells.
+        # moves across a corner are kept by the border on the left of it.
+        for x, y in cells:
+            if not is_passable((x, y)) or is_passable((x + dx, y + dy)):
+                continue
+            for side in (-1, 1):
+                along = (x + dy * side, y + dx * side)
+                other = (along[0] + dx, along[1] + dy)
+                if dy and not x0 <= along[0] <= x1:
+                    continue
+                if is_passable(other) and not is_passable(along):
+                    pairs.append(((x, y), other, 2))
+
+        old = self._borders.get(border, [])
+        if pairs == old:
+            return set()
+
+        # forget the old transitions
+        inter = self._inter
+        for a, b, cost in old:
+            for p, q in ((a, b), (b, a)):
+                edges = inter[p]
+                del edges[q]
+                if not edges:
+                    del inter[p]
+                self.unmark(p)
+
+        for a, b, cost in pairs:
+            inter.setdefault(a, {})[b] = cost
+            inter.setdefault(b, {})[a] = cost
+            self.mark(a)
+            self.mark(b)
+
+        self._borders[border] = pairs
+
+        changed = set()
+        for a, b, cost in old + pairs:
+            changed.add(self.cluster(a))
+            changed.add(self.cluster(b))
+        return changed
+
+    def mark(self, point):
+        entrances = self._entrances.setdefault(self.cluster(point), {})
+        entrances[point] = entrances.get(point, 0) + 1
+
+    def unmark(self, point):
+        cluster = self.cluster(point)
+        entrances = self._entrances[cluster]
+        entrances[point] -= 1
+        if not entrances[point]:
+            del entrances[point]
+
+    def entrances(self, cluster):
+        """
+        Return the transitions in a cluster.
+        """
+        return set(self._entrances.get(cluster, ()))
+
+    def build_cluster(self, cluster):
+        """
+        Find the cost between each pair of transitions in a cluster.
+        """
+        cx, cy = cluster
+        if not (0 <= cx < self.columns and 0 <= cy < self.rows):
+            return
+
+        bounds = self.bounds(cluster)
+        entrances = sorted(self.entrances(cluster))
+        table = moves(self.grid, bounds)
+
+        edges = dict( (p, {}) for p in entrances )
+        for n, p in enumerate(entrances):
+            targets = entrances[n + 1:]
+            if not targets:
+                break
+            for q, cost in costs(table, bounds, p, targets).iteritems():
+                edges[p][q] = cost
+                edges[q][p] = cost
+
+        self._intra[cluster] = edges
+        self._paths[cluster] = {}
+
+    def abstract_path(self, start, finish):
+        """
+        Return the transitions that a path from start to finish goes
+        through, including start and finish, or an empty list if there is
+        no path.
+        """
+
+        start = tuple(start)
+        finish = tuple(finish)
+
+        if self._built != self.grid.version:
+            self.build()
+
+        if not (self.is_passable(start) and self.is_passable(finish)):
+            return []
+
+        if start == finish:
+            return [start]
+
+        first = self.cluster(start)
+        last = self.cluster(finish)
+
+        # connect the start and finish to the graph
+        bounds = self.bounds(first)
+        exits = costs(moves(self.grid, bounds), bounds, start,
+                      self._intra[first])
+        if first == last:
+            path = self.grid.search(start, finish, bounds)
+            if path:
+                exits[finish] = path_cost(path)
+
+        bounds = self.bounds(last)
+        goals = costs(moves(self.grid, bounds), bounds, finish,
+                      self._intra[last])
+
+        inter = self._inter
+        intra = self._intra
+        cluster = self.cluster
+        fx, fy = finish
+
+        parents = {start: None}
+        g = {start: 0}
+        closed = set()
+        openlist = [(abs(fx - start[0]) + abs(fy - start[1]), 0, start)]
+
+        while openlist:
+            f, score, point = heappop(openlist)
+            if point in closed:
+                continue
+
+            if point == finish:
+                path = []
+                while point is not None:
+                    path.append(point)
+                    point = parents[point]
+                path.reverse()
+                return path
+
+            closed.add(point)
+            score = g[point]
+
+            if point == start:
+                neighbors = exits.items()
+            else:
+                neighbors = intra[cluster(point)][point].items()
+            neighbors.extend(inter.get(point, {}).items())
+            if point in goals:
+                neighbors.append((finish, goals[point]))
+
+            for other, cost in neighbors:
+                if other in closed:
+                    continue
+
+                total = score + cost
+                if total < g.get(other, total + 1):
+                    g[other] = total
+                    parents[other] = point
+                    x, y = other
+                    f = total + abs(fx - x) + abs(fy - y)
+                    heappush(openlist, (f, -total, other))
+
+        return []
+
+    def refine(self, nodes):
+        """
+        Yield the cells of the path through nodes, which is a path returned
+        by abstract_path(), from start to finish.  The path is refined one
+        cluster at a time, as it is needed.
+        """
+
+        if not nodes:
+            return
+
+        yield nodes[0]
+
+        for a, b in zip(nodes, nodes[1:]):
+            first = self.cluster(a)
+            if first != self.cluster(b):
+                # crossing a border
+                yield b
+                continue
+
+            # only paths between transitions are kept, since they are the
+            # ones that are used again
+            paths = self._paths[first]
+            try:
+                path = paths[(a, b)]
+            except KeyError:
+                path = self.grid.search(a, b, self.bounds(first))
+                if a in self._intra[first] and b in self._intra[first]:
+                    paths[(a, b)] = path
+
+            # paths are from b back to a
+            for i in xrange(len(path) - 2, -1, -1):
+                yield path[i]
+
+    def search(self, start, finish, bounds=None):
+        """
+        Return a path like Grid.search does, from finish back to start, or
+        an empty list if there is no path.
+        """
+        if bounds is not None:
+            return self.grid.search(start, finish, bounds)
+
+        path = list(self.refine(self.abstract_path(start, finish)))
+        path.reverse()
+        return path
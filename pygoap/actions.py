@@ -29,12 +29,26 @@ class ActionBuilder(object):
     ActionBuilders examine a blackboard and return a list of actions that can
     be successfully completed at the time.
 
-    The actions that are returned will be assumed to be valid and will not be
-    tested.  Please make sure that the actions are valid.
+    Actions can list the conditions they require in prereqs.  The planner
+    will test them and skip actions that cannot be started.  Conditions that
+    are not in prereqs are not tested, so please make sure that the actions
+    are otherwise valid.
+
+    Builders can declare the terms (see precepts.precept_terms) of the
+    precepts that they read from memory and that their actions produce, as
+    tuples in reads and produces.  The planner uses them to skip builders
+    that cannot help satisfy the goal, and to reuse actions when nothing
+    the builder reads has changed.  None means anything could be read or
+    produced, and the builder will always be called.
     """
 
+    reads = None
+    produces = None
+
     def __call__(self, parent, memory):
-        return self.get_actions(parent, memory)
+        for action in self.get_actions(parent, memory):
+            action.builder = self
+            yield action
 
     def get_actions(self, parent, memory):
         """
@@ -57,6 +71,7 @@ class ActionContext(object):
         self.prereqs = []
         self.effects = []
         self.costs   = {}
+        self.builder = None         # the ActionBuilder that made this
         self.__dict__.update(kwargs)
 
     def __enter__(self):
@@ -133,7 +148,9 @@ class ActionContext(object):
 
         if not self.prereqs: return 1.0
 
-        if memory is None: raise Exception
+        if memory is None:
+            memory = self.parent.memory
+
         values = ( i.test(memory) for i in self.prereqs )
 
         try:
@@ -143,6 +160,36 @@ class ActionContext(object):
             print test_fail_msg
             sys.exit(1)
 
+    def calc_cost(self, memory=None):
+        """
+        Return the cost of performing this context, according to memory.
+
+        costs is a dict of named costs.  the values can be numbers or callables
+        that accept a memory and return a number, for example, a cost that
+        depends on the distance to walk.  the costs are added together.  if
+        there are no costs, then the cost is 1.
+        """
+
+        if not self.costs: return 1
+
+        total = 0
+        for value in self.costs.values():
+            if callable(value):
+                value = value(memory)
+            total += value
+
+        return total
+
+    def cost_key(self):
+        """
+        Return a hashable value that identifies the cost of this context, or
+        None if the cost should not be cached.
+
+        the planner will only calculate the cost once for each key, so the
+        key must include any part of the memory that the costs depend on.
+        """
+        return None
+
     def touch(self, memory=None):
         """
         Call after the planning phase is complete.
@@ -1,9 +1,14 @@
 from environment import ObjectBase
-from planning import plan
+from planning import plan, PlanCache, touched
 from actions import ActionContext
 from memory import MemoryManager
+from blackboard import OldestEviction
+import blackboard
 from actionstates import *
 from precepts import *
+from goals import CompoundGoal
+from priority import PriorityTable
+from time import time
 import logging
 
 debug = logging.debug
@@ -26,15 +31,44 @@ class GoapAgent(ObjectBase):
     currently, only one action running concurrently is supported.
     """
 
-    # this will set this class to listen for this type of precept
-    # not implemented yet
+    # types of precepts that this agent will be sent by the environment.
+    # if empty, the agent is interested in everything.
     interested = []
     idle_timeout = 30
 
+    # how far the agent can see, or None to see everything
+    perception_range = None
+
+    # if true, newer positions and data replace older ones in memory.  see
+    # memory.MemoryManager
+    keyed_memory = False
+
+    # agents only remember this many precepts.  memory_eviction is called to
+    # make the policy that chooses what is forgotten.  see blackboard.py
+    memory_capacity = 20
+    memory_eviction = OldestEviction
+
+    # set this to a PlanCache to share plans between all instances
+    shared_plan_cache = None
+
+    # limits for planning in each frame.  if the nodes or time (in
+    # microseconds) run out, planning will continue in the next frame.  a
+    # frame starts when the agent is sent a TimePrecept.
+    max_plan_nodes = None
+    max_plan_time = None
+    max_plan_depth = None
+
     def __init__(self, name=None):
         super(GoapAgent, self).__init__(name)
-        self.memory = MemoryManager()
+        self.memory = blackboard.MemoryManager(keyed=self.keyed_memory,
+            capacity=self.memory_capacity, eviction=self.memory_eviction())
         self.planner = plan
+        self.heuristic = None       # estimate used by the planner
+
+        if self.shared_plan_cache is None:
+            self.plan_cache = PlanCache()
+        else:
+            self.plan_cache = self.shared_plan_cache
 
         self.current_goal = None
 
@@ -44,14 +78,83 @@ class GoapAgent(ObjectBase):
         self.plan = []              # list of actions to perform
                                     # '-1' will be the action currently used
 
+        self.tentative_goals = []   # goals that are waiting to be planned
+        self.search = None          # search that is waiting to continue
+        self.batched = False        # waiting for a plan from a batch planner
+        self.changed = False        # memory has changed since the plan was
+                                    # last checked
+        self.refill_budget()
+
+        # the relevancy of each goal is kept, and only tested again when
+        # something the goal reads has changed in memory
+        self.relevancy = {}         # goal -> last relevancy
+        self.dirty_goals = set()    # goals that need to be tested again
+        self.goal_terms = {}        # term -> goals that read it
+        self.goal_order = {}        # goal -> order it was added, for ties
+        self.goal_table = PriorityTable()   # goal -> (-relevancy, order)
+        self.memory.observers.append(self.memory_changed)
+
         # this special filter will prevent time precepts from being stored
         self.filters.append(time_filter)
 
     def add_goal(self, goal):
         self.goals.append(goal)
+        self.goal_order[goal] = len(self.goal_order)
+        for term in goal.reads if goal.reads is not None else (None,):
+            self.goal_terms.setdefault(term, set()).add(goal)
+        self.dirty_goals.add(goal)
 
     def remove_goal(self, goal):
         self.goals.remove(goal)
+        for goals in self.goal_terms.values():
+            goals.discard(goal)
+        self.dirty_goals.discard(goal)
+        self.relevancy.pop(goal, None)
+        self.goal_order.pop(goal, None)
+        self.goal_table.remove(goal)
+
+    def memory_changed(self, precept):
+        """
+        called by memory when a precept is added or removed
+        """
+        for term in precept_terms(precept):
+            goals = self.goal_terms.get(term)
+            if goals:
+                self.dirty_goals.update(goals)
+
+    def update_relevancy(self):
+        """
+        test the goals that may have changed since the last time
+        """
+
+        # goals that could read anything are always tested
+        dirty = self.dirty_goals
+        dirty.update(self.goal_terms.get(None, ()))
+
+        for goal in dirty:
+            score = goal.get_relevancy(self.memory)
+            if goal in self.goal_table and score == self.relevancy[goal]:
+                continue
+
+            self.relevancy[goal] = score
+            self.goal_table.push(goal, (-score, self.goal_order[goal]))
+
+        dirty.clear()
+
+    def relevant_goals(self):
+        """
+        return the goals that are relevant, the most relevant first
+        """
+        self.update_relevancy()
+
+        # take the relevant goals off the table in order, then put them back
+        table = self.goal_table
+        entries = []
+        while table and table.peek()[0][0] < 0.0:
+            entries.append(table.pop())
+
+        [ table.push(goal, key) for key, goal in entries ]
+        return [ goal for key, goal in entries ]
 
     def add_action(self, action):
         self.actions.append(action)
@@ -59,6 +162,24 @@ class GoapAgent(ObjectBase):
     def remove_action(self, action):
         self.actions.remove(action)
 
+    def interested_in_type(self, klass):
+        """
+        return True if the agent wants to be sent precepts of this type
+
+        the environment asks once for each type of precept that it sends,
+        so this must not depend on what is in the precepts.  use filters to
+        drop precepts because of what they contain.
+        """
+        if not self.interested:
+            return True
+        return issubclass(klass, tuple(self.interested))
+
+    def interested_in(self, precept):
+        """
+        return True if the agent wants to be sent the precept
+        """
+        return self.interested_in_type(precept.__class__)
+
     def filter_precept(self, precept):
         """
         precepts can be put through filters to change them.
@@ -71,19 +192,42 @@ class GoapAgent(ObjectBase):
 
         return precept
 
+    def refill_budget(self):
+        """
+        reset the planning limits for a new frame
+        """
+        self.plan_nodes_left = self.max_plan_nodes
+        self.plan_time_left = self.max_plan_time
+
     def process(self, precept):
         """
         used by the environment to feed the agent precepts.
         agents can respond by sending back an action to take.
         """
+        frame = isinstance(precept, TimePrecept)
+        if frame:
+            self.refill_budget()
+
         precept = self.filter_precept(precept)
 
         if precept:
             debug("[agent] %s recv'd precept %s", self, precept)
+            if precept not in self.memory:
+                self.changed = True
             self.memory.add(precept)
 
-        if self.next_action is NullAction:
-            self.replan()
+        # if something has changed, make sure the plan still works.  this is
+        # done once a frame, since many precepts can arrive in one.
+        if frame and self.changed:
+            self.changed = False
+            if self.plan:
+                self.repair_plan()
+
+        if self.next_action is NullAction and not self.batched:
+            if self.tentative_goals:
+                self.continue_planning()
+            else:
+                self.replan()
             return self.next_action
 
 
@@ -93,29 +237,205 @@ class GoapAgent(ObjectBase):
         """
 
         # get the relevancy of each goal according to the state of the agent
-        s = ( (g.get_relevancy(self.memory), g) for g in self.goals )
-        s = [ g for g in s if g[0] > 0.0 ]
-        s.sort(reverse=True)
+        goals = self.relevant_goals()
 
-        debug("[agent] %s has goals %s", self, s)
-
-        start_action = NullAction
+        debug("[agent] %s has goals %s", self, goals)
 
         # starting for the most relevant goal, attempt to make a plan
-        self.plan = []      
-        for score, goal in s:
-            tentative_plan = self.planner(self, self.actions,
-                start_action, self.memory, goal)
+        self.plan = []
+        self.search = None
+        self.tentative_goals = goals
+
+        # the environment may plan for many agents at once
+        environment = getattr(self, 'environment', None)
+        batch_planner = getattr(environment, 'batch_planner', None)
+        if batch_planner is not None and self.tentative_goals:
+            batch_planner.request(self)
+            return
+
+        self.continue_planning()
+
+    def continue_planning(self):
+        """
+        plan for the tentative goals, in order, until one has a plan
+
+        if the planning limits for this frame are reached, the search is
+        kept and will be continued the next time this is called.
+        """
+
+        start_action = NullAction
+        budgeted = self.max_plan_nodes is not None or \
+                   self.max_plan_time is not None
+        search_class = getattr(self.planner, 'search', None)
+
+        while self.tentative_goals:
+            goal = self.tentative_goals[0]
+
+            if self.search is None:
+                if not budgeted or search_class is None:
+                    tentative_plan = self.plan_cache.plan(self.planner, self,
+                        self.actions, start_action, self.memory, goal,
+                        heuristic=self.heuristic,
+                        max_depth=self.max_plan_depth)
+                else:
+                    key = self.plan_cache.key(self, self.actions, goal,
+                        self.memory)
+                    tentative_plan = self.plan_cache.lookup(key, self,
+                        self.actions, start_action, self.memory, goal)
+
+                    # the search gets a snapshot, since memory will change
+                    # between the times that it runs
+                    if tentative_plan is None:
+                        self.search = search_class(self, self.actions,
+                            start_action, self.memory.snapshot(), goal,
+                            self.heuristic, self.max_plan_depth)
+                        self.search.cache_key = key
+
+            if self.search is not None:
+                if not self.run_search(self.search):
+                    debug("[agent] %s will continue planning %s", self, goal)
+                    return
+
+                tentative_plan = self.search.path
+                self.plan_cache.store(self.search.cache_key, self,
+                    self.actions, tentative_plan)
+                self.search = None
+
+            self.tentative_goals.pop(0)
 
             if tentative_plan:
-                tentative_plan.pop()
-                pretty = list(reversed(tentative_plan[:]))
-                debug("[agent] %s has planned to %s", self, goal)
-                debug("[agent] %s has plan %s", self, pretty)
-                self.plan = tentative_plan
-                self.current_goal = goal
-                break
+                self.use_plan(goal, tentative_plan)
+                self.tentative_goals = []
+                return
+
+    def run_search(self, search):
+        """
+        run a search with what is left of the planning limits for this
+        frame, and return True if it is done
+        """
+        started = time()
+        expanded = search.expanded
+        done = search.run(self.plan_nodes_left, self.plan_time_left)
 
+        if self.plan_nodes_left is not None:
+            self.plan_nodes_left -= search.expanded - expanded
+        if self.plan_time_left is not None:
+            self.plan_time_left -= (time() - started) * 1000000
+
+        return done
+
+    def use_plan(self, goal, tentative_plan):
+        """
+        follow a plan, as returned by the planner, to satisfy goal
+        """
+        tentative_plan.pop()
+        pretty = list(reversed(tentative_plan[:]))
+        debug("[agent] %s has planned to %s", self, goal)
+        debug("[agent] %s has plan %s", self, pretty)
+        self.plan = tentative_plan
+        self.current_goal = goal
+
+
+    def check_plan(self, plan=None):
+        """
+        simulate the plan from memory, without running it
+
+        return the index of the first action in the plan that cannot be
+        started, -1 if the goal is not satisfied at the end, or None if the
+        plan works.  the simulated memory before that point is also
+        returned, as a snapshot.
+        """
+
+        if plan is None:
+            plan = self.plan
+
+        memory = self.memory.snapshot()
+
+        # the plan is reversed, so the next action is last
+        for index in reversed(xrange(len(plan))):
+            action = plan[index]
+            if action.state == ACTIONSTATE_NOT_STARTED:
+                if action.test(memory) < 1.0:
+                    return index, memory
+            memory = memory.layer(touched(action.effects))
+
+        if self.current_goal and self.current_goal.test(memory) < 1.0:
+            return -1, memory
+
+        return None, memory
+
+    def repair_plan(self):
+        """
+        check the rest of the plan against the memory and patch it if needed
+
+        the actions before the broken one are kept.  first, a plan to make
+        the broken action possible is searched for.  if that doesn't work,
+        then a plan to the goal from where the plan broke.  if neither can
+        be found, the plan is dropped after the current action is done.
+
+        the searches use the planning limits for this frame.  if they run
+        out, the plan is dropped too, and the agent plans again with
+        continue_planning.
+        """
+
+        broken, memory = self.check_plan()
+        if broken is None:
+            return
+
+        goal = self.current_goal
+        debug("[agent] %s plan is broken at %s", self, broken)
+
+        search_class = getattr(self.planner, 'search', None)
+        budgeted = self.max_plan_nodes is not None or \
+                   self.max_plan_time is not None
+
+        def patch(patch_goal, memory):
+            if not budgeted or search_class is None:
+                path = self.plan_cache.plan(self.planner, self, self.actions,
+                    NullAction, memory, patch_goal, heuristic=self.heuristic,
+                    max_depth=self.max_plan_depth)
+                return path[:-1]
+
+            key = self.plan_cache.key(self, self.actions, patch_goal, memory)
+            path = self.plan_cache.lookup(key, self, self.actions,
+                NullAction, memory, patch_goal)
+            if path is None:
+                search = search_class(self, self.actions, NullAction, memory,
+                    patch_goal, self.heuristic, self.max_plan_depth)
+                if not self.run_search(search):
+                    return []
+
+                path = search.path
+                self.plan_cache.store(key, self, self.actions, path)
+            return path[:-1]
+
+        # when only the goal is not met, the whole plan is kept
+        prefix = self.plan[broken+1:]
+        if broken >= 0:
+            prereqs = self.plan[broken].prereqs
+            if prereqs:
+                path = patch(CompoundGoal(*prereqs), memory)
+                if path:
+                    plan = self.plan[:broken+1] + path + prefix
+                    if self.check_plan(plan)[0] is None:
+                        debug("[agent] %s patched plan with %s", self, path)
+                        self.plan = plan
+                        return
+
+        if goal is not None:
+            path = patch(goal, memory)
+            if path:
+                debug("[agent] %s patched plan with %s", self, path)
+                self.plan = path + prefix
+                return
+
+        # the agent will have to make a new plan
+        debug("[agent] %s could not patch plan", self)
+        if self.current_action.state == ACTIONSTATE_RUNNING:
+            self.plan = self.plan[-1:]
+        else:
+            self.plan = []
+        self.current_goal = None
 
     # we only support one concurrent action (i'm lazy)
     def running_actions(self):
@@ -0,0 +1,307 @@
+"""
+Planning is the most expensive thing that an agent does, and python will only
+use one processor at a time.  The BatchPlanner collects the agents that need
+a plan during an environment update and solves them together in a pool of
+processes.
+
+The pool is forked once and kept for as long as it can be used.  The workers
+start with a copy of the agents, the entities and the environments as they
+were at that moment, and each request sends them the agent's memory and
+goals.  Objects that are in the copy, such as agents, entities and
+environments, are sent as their id, which is the same in both processes
+because of the fork.  The plans are sent back as the index of each builder
+and the precepts its action touched, and then the plans are remade in the
+main process with planning.replay().
+
+If a request refers to an object that the workers don't have, or an agent's
+builders or its environment's map have changed since the fork, then the pool
+is forked again.
+"""
+
+from environment import ObjectBase, Environment
+from planning import replay, touched
+from agent import GoapAgent, NullAction
+from memory import MemoryManager
+from cStringIO import StringIO
+import cPickle as pickle
+import multiprocessing
+import os
+import logging
+
+debug = logging.debug
+
+
+
+# the objects that can be sent by their id.  workers get a copy when forked.
+_objects = {}
+
+
+def _persistent_id(obj):
+    if isinstance(obj, (ObjectBase, Environment)):
+        return str(id(obj))
+    return None
+
+
+def _dumps(obj, found=None):
+    """
+    Pickle obj, sending objects by their id.  If found is a dict, the
+    objects that were sent by id are added to it.
+    """
+
+    def persistent_id(obj):
+        key = _persistent_id(obj)
+        if key is not None and found is not None:
+            found[key] = obj
+        return key
+
+    f = StringIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    return f.getvalue()
+
+
+def _loads(data):
+    unpickler = pickle.Unpickler(StringIO(data))
+    unpickler.persistent_load = _objects.get
+    return unpickler.load()
+
+
+def _solve(request):
+    """
+    Find a plan for a request, in a worker process.
+
+    Return the index of the goal that has a plan (or None), and the plan as
+    a pickled list of (builder index, effects).
+    """
+
+    agent_id, data = request
+    agent = _objects[agent_id]
+    goals, precepts, keyed = _loads(data)
+
+    # the copy of the agent thinks what the agent thinks now
+    memory = MemoryManager(precepts, keyed=keyed)
+    agent.memory = memory
+
+    for goal_index, goal in enumerate(goals):
+        path = agent.planner(agent, agent.actions, NullAction, memory,
+                             goal, heuristic=agent.heuristic,
+                             max_depth=agent.max_plan_depth)
+        if path:
+            break
+    else:
+        return None, None
+
+    steps = [ (agent.actions.index(a.builder), touched(a.effects))
+              for a in reversed(path[:-1]) ]
+
+    return goal_index, _dumps(steps)
+
+
+def _state(obj):
+    """
+    Return what the workers' copy of obj depends on, other than memory.
+    """
+    if isinstance(obj, GoapAgent):
+        return tuple( id(i) for i in obj.actions )
+
+    grid_version = getattr(obj, 'grid_version', None)
+    if grid_version is not None:
+        return grid_version()
+
+    return None
+
+
+class BatchPlanner(object):
+    """
+    Plan for many agents at once with a pool of processes.
+
+    Set an environment's batch_planner to use one.  Agents that need to
+    replan will request a plan instead, and the environment will solve the
+    batch after all the agents have processed the time precept.
+
+    processes is the size of the pool, by default the number of processors.
+    If there are fewer than min_batch requests, or the platform can't fork,
+    then the agents plan for themselves, one at a time.
+
+    Call close() when the planner is no longer needed, to stop the pool.
+    """
+
+    def __init__(self, processes=None, min_batch=2):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        self.processes = processes
+        self.min_batch = min_batch
+        self.agents = []
+        self.forks = 0
+
+        self._pool = None
+        self._states = {}           # id -> _state() when the pool forked
+
+    def request(self, agent):
+        """
+        Ask for agent to plan for its tentative goals in the next batch.
+        """
+        if not agent in self.agents:
+            agent.batched = True
+            self.agents.append(agent)
+
+    def solve(self):
+        """
+        Find plans for all the agents that have requested them.
+        """
+
+        agents = self.agents
+        self.agents = []
+
+        requests = []
+        for agent in agents:
+            agent.batched = False
+            goals = self.uncached_goals(agent)
+            if goals:
+                requests.append((agent, goals))
+
+        if not requests:
+            return
+
+        if len(requests) < self.min_batch or self.processes < 2 or \
+            not hasattr(os, 'fork'):
+            for agent, goals in requests:
+                agent.continue_planning()
+            return
+
+        debug("[batch] solving %s plans", len(requests))
+
+        found = {}
+        messages = []
+        for agent, goals in requests:
+            found[str(id(agent))] = agent
+            data = _dumps((goals, list(agent.memory), agent.memory.keyed),
+                          found)
+            messages.append((str(id(agent)), data))
+
+        environments = set( getattr(agent, 'environment', None)
+                            for agent, goals in requests )
+        environments.discard(None)
+        found.update( (str(id(i)), i) for i in environments )
+
+        if not self.usable(found):
+            self.fork(found, environments)
+
+        results = self._pool.map(_solve, messages)
+
+        for (agent, goals), (goal_index, data) in zip(requests, results):
+            self.use_result(agent, goals, goal_index, data)
+
+    def usable(self, found):
+        """
+        Return True if the workers have up to date copies of the objects.
+        """
+        if self._pool is None:
+            return False
+
+        for key, obj in found.iteritems():
+            if _objects.get(key) is not obj:
+                return False
+            if key in self._states and self._states[key] != _state(obj):
+                return False
+
+        return True
+
+    def fork(self, found, environments):
+        """
+        Start a new pool, with copies of the objects as they are now.
+        """
+
+        global _objects
+
+        self.close()
+
+        objects = dict(found)
+        for environment in environments:
+            for entity in environment.entities:
+                objects[str(id(entity))] = entity
+
+        _objects = objects
+        self._states = dict( (key, _state(obj))
+                             for key, obj in objects.iteritems() )
+
+        debug("[batch] forking %s workers", self.processes)
+        self._pool = multiprocessing.Pool(self.processes)
+        self.forks += 1
+
+    def close(self):
+        """
+        Stop the pool.  It will be started again if it is needed.
+        """
+
+        global _objects
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+        _objects = {}
+        self._states = {}
+
+    def uncached_goals(self, agent):
+        """
+        Use the agent's plan cache for as many of its goals as possible.
+
+        Return the goals that still need to be searched, in order.
+        """
+
+        while agent.tentative_goals:
+            goal = agent.tentative_goals[0]
+            key = agent.plan_cache.key(agent, agent.actions, goal,
+                agent.memory)
+            path = agent.plan_cache.lookup(key, agent, agent.actions,
+                NullAction, agent.memory, goal)
+
+            if path is None:
+                return list(agent.tentative_goals)
+
+            agent.tentative_goals.pop(0)
+            if path:
+                agent.use_plan(goal, path)
+                agent.tentative_goals = []
+
+        return []
+
+    def use_result(self, agent, goals, goal_index, data):
+        """
+        Remake the plan sent by a worker and give it to the agent.
+        """
+
+        cache = agent.plan_cache
+        if goal_index is None:
+            tried = goals
+        else:
+            tried = goals[:goal_index]
+
+        # the goals that failed can be remembered
+        for goal in tried:
+            key = cache.key(agent, agent.actions, goal, agent.memory)
+            cache.store(key, agent, agent.actions, [])
+
+        if goal_index is None:
+            agent.tentative_goals = []
+            return
+
+        goal = goals[goal_index]
+        steps = [ (agent.actions[i], effects)
+                  for i, effects in _loads(data) ]
+
+        path = replay(agent, steps, NullAction, agent.memory, goal)
+        if not path:
+            # the plan refers to something the worker made, so plan here
+            agent.tentative_goals = goals[goal_index:]
+            agent.continue_planning()
+            return
+
+        key = cache.key(agent, agent.actions, goal, agent.memory)
+        cache.store(key, agent, agent.actions, path)
+        agent.tentative_goals = []
+        agent.use_plan(goal, path)
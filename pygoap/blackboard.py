@@ -1,26 +1,376 @@
 """
-Memories are stored precepts.
+Memories that forget.
+
+An agent that remembers everything that it has seen will slowly use all the
+memory that there is, so the memory of an agent is limited.  When it is full,
+an eviction policy chooses the precept to forget.  Precepts that the agent
+cannot reason without, like who it is, can be pinned and will never be
+forgotten.
+
+Agents in a team can also share a blackboard, so that what one of them
+sees is known by all of them, and is only stored once.
 """
 
+from memory import MemoryManager as BaseMemoryManager
+from precepts import DatumPrecept, PositionPrecept
+from collections import OrderedDict
+from priority import PriorityTable
+from itertools import count, chain
+
+
+
+class Eviction(object):
+    """
+    Chooses which precept will be forgotten when a memory is full.
+
+    An eviction belongs to one memory, which will let it know when precepts
+    are added, removed or accessed.
+    """
+
+    # if true, the memory will tell the eviction when precepts are read
+    tracks_access = False
+
+    def added(self, precept):
+        """
+        called when the precept is added, or is observed again
+        """
+        pass
+
+    def accessed(self, precept):
+        """
+        called when the precept is read from memory
+        """
+        pass
+
+    def removed(self, precept):
+        """
+        called when the precept is removed
+        """
+        pass
+
+    def clear(self):
+        pass
+
+    def victim(self, memory):
+        """
+        return the precept to forget, or None if nothing can be forgotten
+        """
+        raise NotImplementedError
+
+
+class OldestEviction(Eviction):
+    """
+    Forget the precept that was observed the longest time ago.
+    """
+
+    def __init__(self):
+        self._order = OrderedDict()
+
+    def added(self, precept):
+        self._order.pop(precept, None)
+        self._order[precept] = None
+
+    def removed(self, precept):
+        self._order.pop(precept, None)
+
+    def clear(self):
+        self._order.clear()
+
+    def victim(self, memory):
+        for precept in self._order:
+            if precept not in memory.pinned:
+                return precept
 
 
-class MemoryManager(set):
+class LRUEviction(OldestEviction):
     """
-    Store and manage precepts.
-    
-    Shared blackboards violate reality in that multiple agents share the same
-    thoughts, to extend the metaphor.  But, the advantage of this is that in
-    a real-time simulation, it gives the player the impression that the agents
-    are able to collaborate in some meaningful way, without a significant
-    impact in performance.
+    Forget the precept that was used the longest time ago.  Looking up a
+    precept, or observing it again, counts as using it.
+    """
+
+    tracks_access = True
+
+    def accessed(self, precept):
+        if precept in self._order:
+            self.added(precept)
+
+
+class SalienceEviction(Eviction):
+    """
+    Forget the least salient precept, and the oldest of those if there are
+    many.
 
-    That being said, i have chosen to restrict blackboards to a per-agent
-    basis.  This library is meant for RPGs, where the action isn't real-time
-    and would require a more realistic simulation of intelligence.
+    score is a callable that is passed a precept and returns its salience.
+    It is only called when the precept is added.
     """
 
+    def __init__(self, score):
+        self.score = score
+        self._table = PriorityTable()   # precept -> (salience, order)
+        self._counter = count()
+
+    def added(self, precept):
+        key = (self.score(precept), next(self._counter))
+        self._table.push(precept, key)
+
+    def removed(self, precept):
+        self._table.remove(precept)
+
+    def clear(self):
+        self._table.clear()
+
+    def victim(self, memory):
+        table = self._table
+        pinned = []
+        victim = None
+        while table:
+            key, precept = table.peek()
+            if precept in memory.pinned:
+                pinned.append(table.pop())
+            else:
+                victim = precept
+                break
+
+        [ table.push(precept, key) for key, precept in pinned ]
+        return victim
+
+
+class MemoryManager(BaseMemoryManager):
+    """
+    A memory that holds at most capacity precepts.
+
+    eviction is the policy that chooses which precept is forgotten when the
+    memory is full.  the default is to forget the oldest one.  pinned
+    precepts are never forgotten, even if the memory is over capacity.
+
+    copies of this memory will remember everything, so the planner can
+    simulate plans without losing the facts it depends on.
+    """
+
+    def __init__(self, precepts=(), keyed=None, capacity=None, eviction=None,
+                 pinned=()):
+        if keyed is None:
+            keyed = getattr(precepts, 'keyed', False)
+        super(MemoryManager, self).__init__(keyed=keyed)
+
+        if eviction is None and capacity is not None:
+            eviction = OldestEviction()
+
+        self.capacity = capacity
+        self.eviction = eviction
+        self.pinned = set()
+
+        self.update(precepts)
+        [ self.pin(i) for i in pinned ]
+
+    def pin(self, precept):
+        """
+        remember the precept and never forget it
+        """
+        self.pinned.add(precept)
+        self.add(precept)
+
+    def unpin(self, precept):
+        self.pinned.discard(precept)
+
+    def add(self, other):
+        if other in self:
+            # observed again
+            if self.eviction is not None:
+                self.eviction.added(other)
+            return
+
+        self._add(other)
+
+    def _add(self, precept):
+        super(MemoryManager, self)._add(precept)
+
+        if self.eviction is not None:
+            self.eviction.added(precept)
+            if self.capacity is not None:
+                self.evict(self.capacity)
+
+    def evict(self, size):
+        """
+        forget precepts until there are no more than size of them
+        """
+        # only count the precepts that are stored here
+        while set.__len__(self) > size:
+            victim = self.eviction.victim(self)
+            if victim is None:
+                break
+            self.remove(victim)
+
+    def remove(self, other):
+        super(MemoryManager, self).remove(other)
+        self.pinned.discard(other)
+        if self.eviction is not None:
+            self.eviction.removed(other)
+
+    def pop(self):
+        precept = super(MemoryManager, self).pop()
+        self.pinned.discard(precept)
+        if self.eviction is not None:
+            self.eviction.removed(precept)
+        return precept
+
+    def clear(self):
+        super(MemoryManager, self).clear()
+        self.pinned.clear()
+        if self.eviction is not None:
+            self.eviction.clear()
+
+    def recall(self, precept):
+        """
+        return True if the precept is remembered.  unlike 'in', this counts
+        as using the precept.
+        """
+        if precept in self:
+            self._accessed((precept,))
+            return True
+        return False
+
+    def _accessed(self, precepts):
+        if self.eviction is not None and self.eviction.tracks_access:
+            [ self.eviction.accessed(i) for i in precepts ]
+        return precepts
+
     def of_class(self, klass):
-        for i in self:
-            if isinstance(i, klass):
-                yield i
+        for i in super(MemoryManager, self).of_class(klass):
+            self._accessed((i,))
+            yield i
+
+    def named(self, name):
+        return self._accessed(super(MemoryManager, self).named(name))
+
+    def about(self, entity):
+        return self._accessed(super(MemoryManager, self).about(entity))
+
+
+class TeamBlackboard(MemoryManager):
+    """
+    A memory that is shared by a team of agents.
+
+    Precepts that the team shares are stored here once, instead of once for
+    each agent.  Each agent that joins the team gets a TeamMemory, which
+    keeps the precepts that are not shared and shows the team's precepts
+    as if they were its own.
+
+    By default, the positions of things are shared, except for the things
+    that an agent is holding.  Override shares() to change that.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TeamBlackboard, self).__init__(*args, **kwargs)
+        self.members = []
+
+    def shares(self, precept):
+        """
+        return True if the precept should be stored in the team's memory
+        """
+        return (isinstance(precept, PositionPrecept) and
+                precept.position[0] != 'self')
+
+    def join(self, agent):
+        """
+        make the agent a member of the team.  the agent's memory is replaced
+        with a TeamMemory that has the same precepts.
+        """
+        old = agent.memory
+        memory = TeamMemory(self, keyed=old.keyed,
+            capacity=getattr(old, 'capacity', None),
+            eviction=agent.memory_eviction())
+
+        memory.update(old)
+        [ memory.pin(i) for i in getattr(old, 'pinned', ()) ]
+        memory.observers.extend(old.observers)
+        agent.memory = memory
+
+    def leave(self, agent):
+        """
+        remove the agent from the team.  it will keep a copy of what it knew.
+        """
+        memory = agent.memory
+        old = MemoryManager(memory, keyed=memory.keyed,
+            capacity=memory.capacity, eviction=agent.memory_eviction(),
+            pinned=memory.pinned)
+        old.observers.extend(memory.observers)
+        self.members.remove(memory)
+        self.observers.remove(memory.notify)
+        agent.memory = old
+
+    def _write(self):
+        # snapshots of the members' memories include this one
+        super(TeamBlackboard, self)._write()
+        [ i._write() for i in self.members ]
+
+
+class TeamMemory(MemoryManager):
+    """
+    The memory of an agent in a team.  See TeamBlackboard.
+
+    Precepts that the team shares are added to the team's memory, and the
+    others are kept here, with the capacity and eviction of this memory.
+    In a keyed memory, precepts only replace precepts that are kept in the
+    same place.
+    """
+
+    complete = False
+
+    def __init__(self, team, *args, **kwargs):
+        self.team = team
+        super(TeamMemory, self).__init__(*args, **kwargs)
+        team.members.append(self)
+
+        # let the agent know when the team learns something
+        team.observers.append(self.notify)
+
+    def add(self, other):
+        if self.team.shares(other):
+            self.team.add(other)
+        else:
+            super(TeamMemory, self).add(other)
+
+    def _add(self, precept):
+        if self.team.shares(precept):
+            self.team.add(precept)
+        else:
+            super(TeamMemory, self)._add(precept)
+
+    def remove(self, other):
+        if set.__contains__(self, other):
+            super(TeamMemory, self).remove(other)
+        else:
+            self.team.remove(other)
+
+    def __contains__(self, precept):
+        return set.__contains__(self, precept) or precept in self.team
+
+    def __iter__(self):
+        return chain(set.__iter__(self), self.team)
+
+    def __len__(self):
+        return set.__len__(self) + len(self.team)
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def of_class(self, klass):
+        return chain(super(TeamMemory, self).of_class(klass),
+                     self.team.of_class(klass))
+
+    def named(self, name):
+        return super(TeamMemory, self).named(name) + self.team.named(name)
+
+    def about(self, entity):
+        return super(TeamMemory, self).about(entity) + self.team.about(entity)
+
+    def replaced_by(self, precept):
+        if self.team.shares(precept):
+            return self.team.replaced_by(precept)
 
+        if isinstance(precept, DatumPrecept):
+            return super(TeamMemory, self).named(precept.name)
+        elif isinstance(precept, PositionPrecept):
+            return super(TeamMemory, self).about(precept.entity)
+        return ()
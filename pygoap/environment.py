@@ -65,6 +65,7 @@ class Environment(object):
         [ self.add(i) for i in agents ]
 
         self.action_que = []
+        self.batch_planner = None   # see batch.BatchPlanner
 
     @property
     def agents(self):
@@ -104,13 +105,7 @@ class Environment(object):
 
         # hackish way to force agents to re-evaulate their environment
         for a in self._agents:
-            to_remove = []
-
-            for p in a.memory.of_class(DatumPrecept):
-                if p.name == 'aware':
-                    to_remove.append(p)
-
-            [ a.memory.remove(p) for p in to_remove]
+            [ a.memory.remove(p) for p in a.memory.named('aware') ]
 
         # add the agent
         if isinstance(entity, GoapAgent):
@@ -120,6 +115,9 @@ class Environment(object):
 
             # clever hack to let the planner know who the memory belongs to
             entity.process(DatumPrecept('self', entity))
+
+            # and to make sure that it is never forgotten
+            entity.memory.pin(DatumPrecept('self', entity))
         else:
             self._entities.append(entity)
 
@@ -140,6 +138,10 @@ class Environment(object):
         p = TimePrecept(self.time) 
         [ a.process(p) for a in self.agents ]
 
+        # find the plans that the agents have requested
+        if self.batch_planner is not None:
+            self.batch_planner.solve()
+
         # get all the running actions for the agents
         self.action_que = [ a.running_actions() for a in self.agents ]
 
@@ -159,10 +161,37 @@ class Environment(object):
         if agents == None:
             agents = self.agents
 
+        agents = list(agents)
         model = self.model_precept
 
+        # the agents that are interested in each type of precept
+        audiences = {}
+
         for p in precepts:
-            [ a.process(model(p, a)) for a in agents ]
+            try:
+                audience = audiences[p.__class__]
+            except KeyError:
+                interested = [ a for a in agents
+                               if a.interested_in_type(p.__class__) ]
+                audience = self.audience(interested)
+                audiences[p.__class__] = audience
+
+            [ a.process(model(p, a)) for a in self.recipients(p, audience) ]
+
+    def audience(self, agents):
+        """
+        prepare a list of agents so that recipients() can quickly find the
+        ones that perceive a precept.
+        """
+        return agents
+
+    def recipients(self, precept, audience):
+        """
+        return the agents in the audience that can perceive the precept.
+        override this to limit who can perceive it.  by default, everyone
+        can.
+        """
+        return audience
 
     def model_precept(self, precept, other):
         """
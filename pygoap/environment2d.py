@@ -11,8 +11,10 @@ is up to you to make it useful.
 
 from agent import GoapAgent
 from environment import Environment
-from pathfinding.astar import search, Node
+from pathfinding.astar import search, Node, Grid
+from pathfinding.flowfield import FlowField
 from precepts import *
+from collections import OrderedDict
 import random, math
 
 
@@ -35,6 +37,21 @@ def clip(vector, lowest, highest):
     return type(vector)(map(min, map(max, vector, lowest), highest))
 
 
+def as_point(position):
+    """Return the (x, y) of a position, which can also be (container, (x, y)).
+    """
+
+    # EPIC HACK
+    # fix this when position conventions are standardized
+    try:
+        if len(position[1]) == 2:
+            return tuple(position[1])
+    except TypeError:
+        pass
+
+    return tuple(position)
+
+
 class Pathfinding2D(object):
     def get_surrounding(self, position):
         """
@@ -49,18 +66,205 @@ class Pathfinding2D(object):
         return distance(position1, position2)
 
     def factory(self, position):
-        
-        # EPIC HACK
-        # fix this when position conventions are standardized
+        return Node(as_point(position))
+
+
+class SpatialHash(object):
+    """
+    Uniform grid of cells that knows which objects are at each point.
+
+    Queries only look at the cells that they overlap, so they take time in
+    proportion to the number of objects nearby, not the number of objects
+    in the world.  cell_size should be about the size of the usual query.
+    """
+
+    def __init__(self, cell_size=8):
+        self.cell_size = cell_size
+        self._cells = {}            # (cx, cy) -> set of objects
+        self._points = {}           # object -> (x, y)
+
+    def cell(self, (x, y)):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def move(self, obj, point):
+        """
+        Place obj at point, which can be None to remove it.
+        """
+        old = self._points.get(obj)
+        if old == point:
+            return
+
+        if old is not None:
+            cell = self.cell(old)
+            objs = self._cells[cell]
+            objs.discard(obj)
+            if not objs:
+                del self._cells[cell]
+            del self._points[obj]
+
+        if point is not None:
+            self._cells.setdefault(self.cell(point), set()).add(obj)
+            self._points[obj] = point
+
+    def remove(self, obj):
+        self.move(obj, None)
+
+    def point(self, obj):
+        return self._points.get(obj)
+
+    def at(self, point):
+        """
+        Return the objects exactly at point.
+        """
+        objs = self._cells.get(self.cell(point), ())
+        return [ obj for obj in objs if self._points[obj] == point ]
+
+    def within(self, (x0, y0, x1, y1)):
+        """
+        Return the objects in the rectangle, including its edges.
+        """
+        cx0, cy0 = self.cell((x0, y0))
+        cx1, cy1 = self.cell((x1, y1))
+        found = []
+        for cx in xrange(cx0, cx1 + 1):
+            for cy in xrange(cy0, cy1 + 1):
+                for obj in self._cells.get((cx, cy), ()):
+                    x, y = self._points[obj]
+                    if x0 <= x <= x1 and y0 <= y <= y1:
+                        found.append(obj)
+        return found
+
+    def near(self, point, radius):
+        """
+        Return the objects within radius of point.
+        """
+        x, y = point
+        radius2 = radius * radius
+        rect = (x - radius, y - radius, x + radius, y + radius)
+        return [ obj for obj in self.within(rect)
+                 if distance2(point, self._points[obj]) <= radius2 ]
+
+
+class PathCache(object):
+    """
+    Remember the paths that have been found, so agents that walk the same
+    routes do not search for them again.
+
+    Paths are stored like search() returns them, from the finish back to
+    the start.  Any part of a shortest path is also a shortest path, so a
+    path can be found in another one that goes through both of its ends,
+    in either direction.
+
+    The paths are for one version of the map.  When the version changes,
+    every path is forgotten.  The least recently used path is dropped when
+    there are more than size paths.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._paths = OrderedDict()     # (start, finish) -> path
+        self._places = {}               # (start, finish) -> {point: index}
+        self._through = {}              # point -> set of (start, finish)
+
+    def __len__(self):
+        return len(self._paths)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def clear(self):
+        self._paths.clear()
+        self._places.clear()
+        self._through.clear()
+
+    def lookup(self, start, finish, version):
+        """
+        Return a copy of the path from start to finish, or None if it is not
+        known for this version of the map.
+        """
+
+        self._check(version)
+
+        key = (start, finish)
         try:
-            if len(position[1]) == 2:
-                x, y = position[1]
-            else:
-                x, y = position
-        except TypeError:
-            x, y = position
-                
-        return Node((x, y))
+            path = self._paths.pop(key)
+        except KeyError:
+            path = self._subpath(start, finish)
+            if path is None:
+                self.misses += 1
+                return None
+        else:
+            self._paths[key] = path
+
+        self.hits += 1
+        return list(path)
+
+    def _check(self, version):
+        # paths are wrong when the map changes
+        if version != self.version:
+            if self._paths:
+                self.invalidations += 1
+                self.clear()
+            self.version = version
+
+    def _subpath(self, start, finish):
+        for key in self._through.get(start, ()):
+            places = self._places[key]
+            try:
+                i = places[finish]
+            except KeyError:
+                continue
+
+            # the path that it was found in was used
+            path = self._paths.pop(key)
+            self._paths[key] = path
+
+            j = places[start]
+            if i <= j:
+                return path[i:j + 1]
+            return path[j:i + 1][::-1]
+
+    def store(self, start, finish, path, version):
+        """
+        Remember the path from start to finish for this version of the map.
+        """
+
+        self._check(version)
+
+        key = (start, finish)
+        if key in self._paths:
+            self._forget(key)
+
+        path = tuple(path)
+        self._paths[key] = path
+
+        # empty paths cannot be searched
+        if path:
+            places = dict( (point, i) for i, point in enumerate(path) )
+            self._places[key] = places
+            for point in places:
+                self._through.setdefault(point, set()).add(key)
+
+        while len(self._paths) > self.size:
+            self._forget(next(iter(self._paths)))
+            self.evictions += 1
+
+    def _forget(self, key):
+        del self._paths[key]
+        for point in self._places.pop(key, ()):
+            keys = self._through[point]
+            keys.discard(key)
+            if not keys:
+                del self._through[point]
 
 
 class XYEnvironment(Environment, Pathfinding2D):
@@ -68,14 +272,34 @@ class XYEnvironment(Environment, Pathfinding2D):
     This class is for environments on a 2D plane.
 
     This class is featured enough to run a simple simulation.
+
+    Entities that are placed on the plane are kept in a SpatialHash, so that
+    the ones near a position can be found quickly.
+
+    Paths are remembered in a PathCache of path_cache_size paths.  Set
+    path_cache to None to search for every path.  The last flow_fields_size
+    flow fields that were made are kept too.
     """
 
-    def __init__(self, width=10, height=10):
+    def __init__(self, width=10, height=10, cell_size=8, path_cache_size=100,
+                 flow_fields_size=8):
+        self.spatial = SpatialHash(cell_size)
         super(XYEnvironment, self).__init__()
         self._positions = {}
+        self._seen = {}             # entity -> last PositionPrecept sent
         self.width = width
         self.height = height
 
+        # set to a pathfinding.astar.Grid, or a map with the same search()
+        # such as a hierarchy.HierarchicalGrid, to search for paths on it
+        # instead of an open plane
+        self.grid = None
+        self.path_cache = PathCache(path_cache_size)
+
+        self.flow_fields_size = flow_fields_size
+        self._flow_fields = OrderedDict()
+        self._plane = None
+
     def add(self, entity):
         super(XYEnvironment, self).add(entity)
         self.set_position(entity, self.default_position())
@@ -83,6 +307,10 @@ class XYEnvironment(Environment, Pathfinding2D):
     def set_position(self, entity, position):
         self._positions[entity] = position
 
+        # only entities on this plane can be found by their position
+        container, point = position
+        self.spatial.move(entity, point if container is self else None)
+
     def get_position(self, entity):
         return self._positions[entity]
 
@@ -99,30 +327,93 @@ class XYEnvironment(Environment, Pathfinding2D):
 
         model = self.model_precept
 
-        for entity in self.entities:
-            parent.process(
-                model(
-                    PositionPrecept(
-                        entity, self.get_position(entity)),
-                    parent
-                )
-            )
+        if not parent.interested_in_type(PositionPrecept):
+            return
+
+        if distance is None:
+            distance = parent.perception_range
+
+        if distance is None:
+            entities = self.entities
+        else:
+            position = self.get_position(parent)
+            entities = self.objects_near(position, distance)
+
+        # every agent that sees an entity in the same place is sent the
+        # same precept.  only the last one made for each entity is kept.
+        seen = self._seen
+        for entity in entities:
+            position = self.get_position(entity)
+            precept = seen.get(entity)
+            if precept is None or precept.position != position:
+                precept = PositionPrecept(entity, position)
+                seen[entity] = precept
+
+            parent.process(model(precept, parent))
+
+    def audience(self, agents):
+        """
+        split the agents into the ones that can see everything, and the
+        ones that can only see what is in their range
+        """
+        found = []
+        ranged = set()
+        for agent in agents:
+            if agent.perception_range is None:
+                found.append(agent)
+            else:
+                ranged.add(agent)
+
+        farthest = max([ a.perception_range for a in ranged ] or [0])
+        return found, ranged, farthest
+
+    def recipients(self, precept, audience):
+        """
+        agents can only perceive positions that are within their range
+        """
+        found, ranged, farthest = audience
+        if not ranged:
+            return found
+
+        if isinstance(precept, PositionPrecept) and \
+            precept.position[0] is self:
+            point = precept.position[1]
+        else:
+            return found + list(ranged)
+
+        found = list(found)
+        for agent in self.spatial.near(point, farthest):
+            if agent in ranged:
+                radius = agent.perception_range
+                if distance2(point, self.spatial.point(agent)) <= radius*radius:
+                    found.append(agent)
+
+        return found
 
     def objects_at(self, position):
         """
         Return all objects exactly at a given position.
         """
-
-        return [ obj for obj in self.entitys if obj.position == position ]
+        container, point = position
+        if container is not self:
+            return []
+        return self.spatial.at(point)
 
     def objects_near(self, position, radius):
         """
         Return all objects within radius of position.
         """
+        container, point = position
+        if container is not self:
+            return []
+        return self.spatial.near(point, radius)
 
-        radius2 = radius * radius
-        return [ obj for obj in self.entitys  
-                if distance2(position, obj.position) <= radius2 ]
+    def objects_in(self, rect):
+        """
+        Return all objects in the rectangle (x0, y0, x1, y1), including the
+        edges.
+        """
+        return self.spatial.within(rect)
 
     def default_position(self):
         loc = (random.randint(0, self.width), random.randint(0, self.height))
@@ -152,4 +443,82 @@ class XYEnvironment(Environment, Pathfinding2D):
         return a path from start to finish
         """
 
-        return search(start, finish, self.factory) 
+        start = as_point(start)
+        finish = as_point(finish)
+        cache = self.path_cache
+        version = self.grid_version()
+
+        if cache is not None:
+            path = cache.lookup(start, finish, version)
+            if path is not None:
+                return path
+
+        if self.grid is not None:
+            path = self.grid.search(start, finish)
+        else:
+            path = search(start, finish, self.factory)
+
+        if cache is not None:
+            cache.store(start, finish, path, version)
+
+        return path
+
+    def flow_field(self, goals, max_distance=None):
+        """
+        return a FlowField to a position, or to the nearest of a list or set
+        of positions.  agents that are going to the same place can share
+        one field, instead of each searching for a path.
+
+        fields are kept until the grid changes, so asking for the same
+        goals again is cheap.  without a grid, the plane is treated as an
+        open grid of its width and height.
+        """
+
+        if isinstance(goals, (list, set, frozenset)):
+            points = frozenset( as_point(i) for i in goals )
+        else:
+            points = frozenset((as_point(goals),))
+
+        key = (points, max_distance)
+        grid = self.passability()
+        fields = self._flow_fields
+        try:
+            field = fields.pop(key)
+        except KeyError:
+            field = None
+        else:
+            if field.stale or field.grid is not grid:
+                field = None
+
+        if field is None:
+            field = FlowField(grid, points, max_distance)
+
+        fields[key] = field
+        while len(fields) > self.flow_fields_size:
+            fields.popitem(last=False)
+
+        return field
+
+    def passability(self):
+        """
+        return the grid that paths are found on.  without a grid, this is an
+        open grid the size of the plane.
+        """
+        if self.grid is not None:
+            return self.grid
+
+        if self._plane is None or \
+            (self._plane.width, self._plane.height) != \
+            (self.width + 1, self.height + 1):
+            # default_position() can place things on the far edges
+            self._plane = Grid(self.width + 1, self.height + 1)
+        return self._plane
+
+    def grid_version(self):
+        """
+        return a value that changes whenever passability changes, or the
+        grid is replaced
+        """
+        if self.grid is None:
+            return None
+        return id(self.grid), self.grid.version
@@ -15,7 +15,6 @@ finished successfully.
 """
 
 from memory import MemoryManager
-from environment2d import distance
 from precepts import *
 import sys, logging
 
@@ -35,8 +34,15 @@ class GoalBase(object):
     The only difference is how they are used.  If a goal is used by the planner
     then that will be the final point of the plan.  if it is used in
     conjunction with an action, then it will function as a prereq.
+
+    reads is a tuple of the terms (see precepts.precept_terms) of the precepts
+    that test() depends on.  agents use it to only recalculate the relevancy
+    of a goal when its memory has changed in a way that matters to the goal.
+    None means the goal could depend on anything.
     """
 
+    reads = None
+
     def __init__(self, *args, **kwargs):
         try:
             self.condition = args[0]
@@ -45,7 +51,9 @@ class GoalBase(object):
 
         self.weight = 1.0
         self.args = args
-        self.kw = kwargs
+
+        # names become the names of DatumPrecepts, so share the strings
+        self.kw = dict( (intern(k), v) for k, v in kwargs.iteritems() )
 
     def touch(self, memory):
         pass
@@ -63,6 +71,16 @@ class GoalBase(object):
         score = 1 - self.test(memory)
         return self.weight * score
 
+    def estimate(self, memory):
+        """
+        will return an estimate of how far memory is from satisfying this
+        goal.  0 means that it is satisfied.
+
+        the planner uses this as a heuristic, so it should never be more than
+        the number of actions required to satisfy the goal.
+        """
+        return 1.0 - self.test(memory)
+
     def self_test(self):
         """
         make sure the goal is sane
@@ -76,12 +94,15 @@ class GoalBase(object):
 
 
 class SimpleGoal(GoalBase):
+    @property
+    def reads(self):
+        return tuple(self.kw.keys())
+
     def test(self, memory):
         total = 0.0
-        for precept in memory:
-            for item in self.kw.items():
-                if precept == item:
-                    total += 1
+        for item in self.kw.items():
+            if DatumPrecept(*item) in memory:
+                total += 1
         return total / len(self.kw)
 
     def touch(self, memory):
@@ -167,6 +188,8 @@ class AlwaysValidGoal(GoalBase):
     Will always be valid.
     """
 
+    reads = ()
+
     def test(self, memory):
         return 1.0
 
@@ -176,50 +199,61 @@ class NeverValidGoal(GoalBase):
     Will never be valid.
     """
 
+    reads = ()
+
     def test(self, memory):
         return 0.0
 
 
+class CompoundGoal(GoalBase):
+    """
+    Combines the goals passed.  Will be valid when all of them are valid.
+    """
+
+    @property
+    def reads(self):
+        terms = set()
+        for i in self.args:
+            if i.reads is None:
+                return None
+            terms.update(i.reads)
+        return tuple(terms)
+
+    def test(self, memory):
+        if not self.args: return 1.0
+        values = [ i.test(memory) for i in self.args ]
+        return float(sum(values)) / len(values)
+
+    def touch(self, memory):
+        for i in self.args:
+            i.touch(memory)
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, list(self.args))
+
+
 class PositionGoal(GoalBase):
     """
     This validator is for finding the position of objects.
     """
 
+    reads = (PositionPrecept,)
+
     def test(self, memory):
         """
-        search memory for last known position of the target
-        if target is not in agent's memory then return 0.0.
-
-        do pathfinding and determine if the target is accessible
-        if not return 0.0
-
-        Determine the distance required to travel to the target
-        return 1.0 if the target is reachable
+        search memory for the position of the target
+        return 1.0 if the target is remembered to be at the position,
+        otherwise return 0.0.
         """
 
-        target = self.args[0]
-        target_position = None
-
         debug("[PositionGoal] testing %s", self.args)
 
-        # find where the target is, according to the memory
-        for precept in memory.of_class(PositionPrecept):
-            if precept.entity is target:
-                target_position = precept.position
-                break
-
-        if target_position == self.args[1]:
+        # the memory may hold many positions for the target, so check for
+        # the position we want instead of the first one found
+        if PositionPrecept(self.args[0], self.args[1]) in memory:
             return 1.0
 
-        else:
-
-            d = distance(position, target_position)
-            if d > self.dist:
-                return (float(self.dist / d)) * float(self.dist)
-            elif d <= self.dist:
-                return 1.0
-            else:
-                return 0.0
+        return 0.0
 
     def touch(self, memory):
         memory.add(PositionPrecept(self.args[0], self.args[1]))
@@ -238,10 +272,11 @@ class HasItemGoal(GoalBase):
     any other keyword will be evaluated against precepts in the memory passed.
     """
 
+    reads = (PositionPrecept,)
+
     def test(self, memory):
-        for precept in memory.of_class(PositionPrecept):
-            if (precept.position[0] == 'self' and
-                precept.entity == self.args[0]):
+        for precept in memory.about(self.args[0]):
+            if precept.position[0] == 'self':
                 return 1.0
         
         return 0.0
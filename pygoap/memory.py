@@ -2,6 +2,9 @@
 Memories are stored precepts.
 """
 
+from precepts import DatumPrecept, PositionPrecept
+import weakref
+
 
 
 class MemoryManager(set):
@@ -16,16 +19,336 @@ class MemoryManager(set):
 
     that being said, i have chosen to restrict blackboards to a per-agent
     basis.  this library is meant for rpgs, where the action isn't real-time
-    and would require a more realistic simulation of intelligence.
+    and would require a more realistic simulation of intelligence.  teams
+    that want to share can use blackboard.TeamBlackboard.
+
+    a memory can be keyed.  a keyed memory only keeps the last position of
+    each entity, and the last value of each datum, so it can only grow when
+    new things are learned.  otherwise, every precept is kept.  see
+    blackboard.MemoryManager for a memory that forgets.
     """
 
+    # false if the memory shows precepts that are not stored in it, so
+    # copies must be made one precept at a time
+    complete = True
+
+    def __init__(self, precepts=(), keyed=None):
+        super(MemoryManager, self).__init__()
+
+        # callables that are called with a precept when it is added or
+        # removed.  copies of the memory do not share observers.
+        self.observers = []
+
+        # a weak reference to the snapshot that shares this memory, until it
+        # is changed.  snapshots that are no longer used don't need a copy.
+        self._shared = None
+
+        # in a keyed memory, a precept replaces the precepts that are about
+        # the same thing.  see precepts.precept_key.  copies are keyed if
+        # the memory they copy is.
+        if keyed is None:
+            keyed = getattr(precepts, 'keyed', False)
+        self.keyed = keyed
+
+        # indexes, so precepts can be found without searching everything
+        if isinstance(precepts, MemoryManager) and precepts.complete and \
+            (precepts.keyed or not keyed):
+            super(MemoryManager, self).update(precepts)
+            self._classes = copy_index(precepts._classes)
+            self._names = copy_index(precepts._names)
+            self._entities = copy_index(precepts._entities)
+        else:
+            self._classes = {}      # type -> precepts
+            self._names = {}        # DatumPrecept.name -> precepts
+            self._entities = {}     # PositionPrecept.entity -> precepts
+            self.update(precepts)
+
+    def _index(self, precept):
+        self._classes.setdefault(precept.__class__, set()).add(precept)
+        if isinstance(precept, DatumPrecept):
+            self._names.setdefault(precept.name, set()).add(precept)
+        elif isinstance(precept, PositionPrecept):
+            self._entities.setdefault(precept.entity, set()).add(precept)
+
+    def _unindex(self, precept):
+        unindex(self._classes, precept.__class__, precept)
+        if isinstance(precept, DatumPrecept):
+            unindex(self._names, precept.name, precept)
+        elif isinstance(precept, PositionPrecept):
+            unindex(self._entities, precept.entity, precept)
+
     def add(self, other):
-        if len(self) > 20:
-            self.pop()
-        super(MemoryManager, self).add(other)
+        if other in self:
+            return
+
+        self._add(other)
+
+    def _write(self):
+        # a snapshot must get its own copy before this memory is changed
+        if self._shared is not None:
+            shared = self._shared()
+            if shared is not None:
+                shared._detach()
+            self._shared = None
+
+    def _add(self, precept):
+        self._write()
+        if self.keyed:
+            [ self.remove(i) for i in self.replaced_by(precept) ]
+
+        super(MemoryManager, self).add(precept)
+        self._index(precept)
+        if self.observers:
+            self.notify(precept)
+
+    def remove(self, other):
+        self._write()
+        super(MemoryManager, self).remove(other)
+        self._unindex(other)
+        self.notify(other)
+
+    def discard(self, other):
+        if other in self:
+            self.remove(other)
+
+    def pop(self):
+        self._write()
+        precept = super(MemoryManager, self).pop()
+        self._unindex(precept)
+        self.notify(precept)
+        return precept
+
+    def clear(self):
+        removed = list(self) if self.observers else []
+        self._write()
+        super(MemoryManager, self).clear()
+        self._classes.clear()
+        self._names.clear()
+        self._entities.clear()
+        [ self.notify(i) for i in removed ]
+
+    def update(self, *others):
+        for other in others:
+            for i in other:
+                if i not in self:
+                    self._add(i)
+
+    def difference_update(self, *others):
+        for other in others:
+            [ self.discard(i) for i in other ]
+
+    def intersection_update(self, *others):
+        keep = set(iter(self)).intersection(*others)
+        [ self.remove(i) for i in list(self) if i not in keep ]
+
+    def symmetric_difference_update(self, other):
+        for i in set(other):
+            if i in self:
+                self.remove(i)
+            else:
+                self._add(i)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def copy(self):
+        return MemoryManager(self)
+
+    # set would return a copy without the indexes
+    def union(self, *others):
+        return MemoryManager(set(iter(self)).union(*others), self.keyed)
+
+    def intersection(self, *others):
+        return MemoryManager(set(iter(self)).intersection(*others), self.keyed)
+
+    def difference(self, *others):
+        return MemoryManager(set(iter(self)).difference(*others), self.keyed)
+
+    def symmetric_difference(self, other):
+        return MemoryManager(set(iter(self)).symmetric_difference(other),
+                             self.keyed)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def __xor__(self, other):
+        return self.symmetric_difference(other)
+
+    def snapshot(self):
+        """
+        return a Snapshot of this memory as it is now
+
+        this is cheap.  the memory is only copied if it is changed while
+        the snapshot is still being used.
+        """
+        shared = None
+        if self._shared is not None:
+            shared = self._shared()
+
+        if shared is None:
+            shared = Snapshot(self)
+            self._shared = weakref.ref(shared)
+        return shared
+
+    def notify(self, precept):
+        for observer in self.observers:
+            observer(precept)
 
     def of_class(self, klass):
-        for i in self:
-            if isinstance(i, klass):
-                yield i
+        """
+        return the precepts that are instances of klass
+        """
+        for k, precepts in self._classes.items():
+            if issubclass(k, klass):
+                for i in list(precepts):
+                    yield i
+
+    def named(self, name):
+        """
+        return the DatumPrecepts with name
+        """
+        return tuple(self._names.get(name, ()))
+
+    def about(self, entity):
+        """
+        return the PositionPrecepts of entity
+        """
+        return tuple(self._entities.get(entity, ()))
+
+    def replaced_by(self, precept):
+        """
+        return the precepts that precept would replace in a keyed memory
+        """
+        if isinstance(precept, DatumPrecept):
+            return self.named(precept.name)
+        elif isinstance(precept, PositionPrecept):
+            return self.about(precept.entity)
+        return ()
+
+
+class Snapshot(object):
+    """
+    A frozen view of a memory, made with MemoryManager.snapshot().
+
+    Snapshots can have layers: a layer is a snapshot with some precepts
+    added, and in a keyed memory, the ones they replace hidden.  Layers
+    share everything else with the snapshot under them, so the planner can
+    branch from a memory without copying it.
+
+    Snapshots have the methods of a memory that do not change it.  Make a
+    MemoryManager from a snapshot to get a memory that can be changed.
+    """
+
+    def __init__(self, memory=None, parent=None, added=(), hidden=()):
+        self._memory = memory       # the memory being shared
+        self._parent = parent       # or the snapshot under this layer
+        self._added = frozenset(added)
+        self._hidden = frozenset(hidden)
+
+        source = self._source()
+        self.keyed = source.keyed
+        self._size = len(source) - len(self._hidden) + len(self._added)
+
+    def _source(self):
+        if self._parent is not None:
+            return self._parent
+        return self._memory
+
+    def _detach(self):
+        # the memory is about to change, so keep a copy of it
+        self._memory = MemoryManager(self._memory)
+
+    def snapshot(self):
+        return self
+
+    def layer(self, precepts):
+        """
+        return a snapshot of this one with the precepts added
+        """
+        source = self._source()
+        added = [ p for p in precepts if p not in source ]
+        if not added:
+            return self
+
+        hidden = set()
+        if self.keyed:
+            for p in added:
+                hidden.update(source.replaced_by(p))
+
+        return Snapshot(parent=self, added=added, hidden=hidden)
+
+    def _merge(self, precepts, test):
+        if not self._hidden:
+            precepts = list(precepts)
+        else:
+            precepts = [ p for p in precepts if p not in self._hidden ]
+        precepts.extend(p for p in self._added if test(p))
+        return precepts
+
+    def __contains__(self, precept):
+        if precept in self._added:
+            return True
+        if precept in self._hidden:
+            return False
+        return precept in self._source()
+
+    def __iter__(self):
+        return iter(self._merge(self._source(), lambda p: True))
+
+    def __len__(self):
+        return self._size
+
+    def __nonzero__(self):
+        return self._size > 0
+
+    def of_class(self, klass):
+        return iter(self._merge(self._source().of_class(klass),
+                                lambda p: isinstance(p, klass)))
+
+    def named(self, name):
+        return tuple(self._merge(self._source().named(name),
+            lambda p: isinstance(p, DatumPrecept) and p.name == name))
+
+    def about(self, entity):
+        return tuple(self._merge(self._source().about(entity),
+            lambda p: isinstance(p, PositionPrecept) and p.entity == entity))
+
+    def replaced_by(self, precept):
+        if isinstance(precept, DatumPrecept):
+            return self.named(precept.name)
+        elif isinstance(precept, PositionPrecept):
+            return self.about(precept.entity)
+        return ()
+
+    def __repr__(self):
+        return "<Snapshot: {} precepts>".format(self._size)
+
+
+def copy_index(index):
+    return dict( (k, set(v)) for k, v in index.iteritems() )
+
 
+def unindex(index, key, precept):
+    precepts = index[key]
+    precepts.discard(precept)
+    if not precepts:
+        del index[key]
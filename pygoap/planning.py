@@ -1,64 +1,206 @@
 from memory import MemoryManager
 from actionstates import *
 from actions import *
+from precepts import precept_terms, precept_key
 
-from heapq import heappop, heappush, heappushpop
-from itertools import permutations, chain
+from heapq import heappop, heappush
+from itertools import count
+from collections import OrderedDict
+from time import time
 import logging
 import sys
 
 debug = logging.debug
 
+# the lowest cost that any action can have.  the default heuristic will
+# overestimate (and plans may not be optimal) if actions cost less than this
+MIN_COST = 1
 
 
-def get_children(parent0, parent, builders):
-    def get_used_class(node):
-        while node.parent is not None:
-            yield node.builder
-            node = node.parent
 
-    used_class = set(get_used_class(parent))
+def goal_heuristic(goal, memory):
+    """
+    Estimate the cost of satisfying the goal from memory.
+
+    Any unsatisfied goal needs at least one more action, so scaling the
+    goal's estimate by the lowest action cost will never overestimate.
+    """
+    return goal.estimate(memory) * MIN_COST
+
+
+def calc_cost(action, memory, cache):
+    """
+    Return the cost of the action, using the cache if the action has a key.
+    """
+    key = action.cost_key()
+    if key is None:
+        return action.calc_cost(memory)
+
+    try:
+        return cache[key]
+    except KeyError:
+        cost = action.calc_cost(memory)
+        cache[key] = cost
+        return cost
+
+
+def relevance(builders, goal):
+    """
+    Return the builders that could help to satisfy the goal, and the terms
+    of the precepts that they, and the goal, depend on.
+
+    A builder is relevant if it produces something the goal needs, or
+    something that another relevant builder reads.  If the goal doesn't
+    touch any precepts, or a relevant builder could read anything, then
+    every builder is returned and the terms are None.
+    """
+
+    wanted = set()
+    for precept in touched([goal]):
+        wanted.update(precept_terms(precept))
+
+    if not wanted:
+        return list(builders), None
+
+    relevant = set()
+    found = True
+    while found:
+        found = False
+        for builder in builders:
+            if builder in relevant:
+                continue
 
-    for builder in builders:
-        if builder in used_class:
+            produces = getattr(builder, 'produces', None)
+            if produces is None or not wanted.isdisjoint(produces):
+                reads = getattr(builder, 'reads', None)
+                if reads is None:
+                    return list(builders), None
+
+                wanted.update(reads)
+                relevant.add(builder)
+                found = True
+
+    return [ b for b in builders if b in relevant ], wanted
+
+
+def relevant_builders(builders, goal):
+    """
+    Return the builders that could help to satisfy the goal.
+    """
+    return relevance(builders, goal)[0]
+
+
+def get_children(parent0, parent, builders, memory=None, cache=None):
+    if memory is None:
+        memory = parent.memory
+
+    if cache is None:
+        cache = {}
+
+    # builders that read nothing that the parent's action changed will
+    # return the same actions as they did for the node before it
+    previous = None
+    if parent.parent is not None:
+        previous = parent.parent.actions
+        changed = set()
+        for precept in parent.delta:
+            changed.update(precept_terms(precept))
+
+    parent.actions = {}
+
+    # builders used by a node are stored as bits of an int, by their index
+    for index, builder in enumerate(builders):
+        mask = 1 << index
+        if parent.used & mask:
             continue
 
-        for action in builder(parent0, parent.memory):
-            node = PlanningNode(parent, builder, action)
-            yield node
+        reads = getattr(builder, 'reads', None)
+        if previous is None or reads is None or not changed.isdisjoint(reads):
+            actions = list(builder(parent0, memory))
+        else:
+            actions = previous[builder]
+
+        parent.actions[builder] = actions
 
+        for action in actions:
+            if action.test(memory) < 1.0:
+                continue
 
-def calcG(node):
-    cost = node.cost
-    while not node.parent == None:
-        node = node.parent
-        cost += node.cost 
-    return cost
+            cost = calc_cost(action, memory, cache)
+            node = PlanningNode(parent, builder, action, mask=mask, cost=cost)
+            yield node
 
 
 class PlanningNode(object):
     """
+    Nodes do not hold a copy of the memory.  They only keep the precepts
+    their action touched (the delta), as a frozenset, and every node in a
+    search shares a snapshot of the root memory it started from.  The memory
+    of a node is a layer over that snapshot, made the first time it is used.
     """
 
-    def __init__(self, parent, builder, action, memory=None):
+    def __init__(self, parent, builder, action, memory=None, mask=0, cost=1):
         self.parent = parent
         self.builder = builder
         self.action = action
-        self.memory = MemoryManager()
-        self.delta = MemoryManager()
-        #self.cost = action.calc_cost()
-        self.cost = 1
-        self.g = calcG(self)
-        self.h = 1
+        self.cost = cost
+        self.h = 0
+        self.actions = None
+        self._memory = None
 
         if parent:
-            self.memory.update(parent.memory)
+            self.root = parent.root
+            self.used = parent.used | mask
+            self.g = parent.g + self.cost
+            self.depth = parent.depth + 1
+            effects = parent.effects
+
+        else:
+            if memory is None:
+                memory = MemoryManager()
+            self.root = memory.snapshot()
+            self.used = mask
+            self.g = 0
+            self.depth = 0
+            effects = frozenset()
 
-        elif memory:
-            self.memory.update(memory)
+        self.delta = touched(action.effects)
 
-        action.touch(self.memory)
-        action.touch(self.delta)
+        # in a keyed memory, the delta replaces older effects about the
+        # same things, even if it puts back what was in the root memory
+        if self.root.keyed and effects:
+            keys = set(precept_key(p) for p in self.delta)
+            keys.discard(None)
+            effects = frozenset(p for p in effects
+                                if precept_key(p) not in keys)
+
+        # precepts added to the root memory by this node and its parents
+        new = [ p for p in self.delta if p not in self.root ]
+        self.effects = effects.union(new) if new else effects
+
+        # nodes with the same key are the same state in the search; the
+        # builders used are part of it, since they cannot be used again
+        self.key = (self.effects, self.used)
+
+    @property
+    def memory(self):
+        """
+        Return a snapshot of root with the effects of this node applied.
+        """
+        if self._memory is None:
+            self._memory = self.root.layer(self.effects)
+        return self._memory
+
+    def path(self):
+        """
+        Return the actions from this node back to the start.
+        """
+        node = self
+        path = [node.action]
+        while node.parent is not None:
+            node = node.parent
+            path.append(node.action)
+        return path
 
     def __eq__(self, other):
         if isinstance(other, PlanningNode):
@@ -79,62 +221,528 @@ class PlanningNode(object):
                 self.cost)
 
 
-def plan(parent, builders, start_action, start_memory, goal):
+class Search(object):
+    """
+    Best first search that can be run a little at a time.
+
+    Subclasses make the first node and its children, and decide when a node
+    is a solution.  Nodes need key, g, h, depth and parent attributes.
+
+    max_depth limits the number of actions in a plan.
+    """
+
+    def __init__(self, max_depth=None):
+        self.max_depth = max_depth
+        self.path = []
+        self.done = False
+        self.expanded = 0
+        self.best = None
+
+        # the counter breaks ties in the heap so nodes are never compared
+        self.counter = count()
+        self.openlist = []
+        self.opened = {}
+        self.closedlist = set()
+
+    def push(self, node):
+        """
+        Add a node to the openlist, unless its state is known to be cheaper.
+        Return True if it was added.
+        """
+        if node.key in self.closedlist:
+            return False
+
+        # only keep the cheapest known way to reach a state.  stale
+        # entries left in the heap are skipped once their state closes
+        try:
+            if self.opened[node.key] <= node.g:
+                return False
+        except KeyError:
+            pass
+
+        self.opened[node.key] = node.g
+        self.estimate(node)
+        heappush(self.openlist, (node.g + node.h, next(self.counter), node))
+        return True
+
+    def run(self, max_nodes=None, max_time=None):
+        """
+        Expand nodes until the search is done, or until max_nodes have been
+        expanded or max_time microseconds have passed.
+
+        Return True if the search is done.  The plan will be in path, and it
+        will be empty if there isn't one.  If the search is not done, then
+        run can be called again to continue it.
+        """
+
+        if self.done:
+            return True
+
+        if max_time is not None:
+            deadline = time() + max_time / 1000000.0
+
+        expanded = 0
+        while self.openlist:
+            if max_nodes is not None and expanded >= max_nodes:
+                return False
+
+            if max_time is not None and time() >= deadline:
+                return False
+
+            # get the best node and remove it from the openlist
+            keyNode = heappop(self.openlist)[2]
+
+            # a cheaper path to this state was already expanded
+            if keyNode.key in self.closedlist:
+                continue
+
+            expanded += 1
+            self.expanded += 1
+
+            if self.solved(keyNode):
+                self.done = True
+                return True
+
+            self.closedlist.add(keyNode.key)
+
+            # the best partial plan is the one that seems closest to the
+            # goal, and the one that has done the most to get there
+            if self.best is None or (keyNode.h, -keyNode.depth) < \
+                (self.best.h, -self.best.depth):
+                self.best = keyNode
+
+            if self.max_depth is not None and keyNode.depth >= self.max_depth:
+                continue
+
+            for child in self.children(keyNode):
+                self.push(child)
+
+        self.done = True
+        return True
+
+    def partial(self):
+        """
+        Return the best plan found so far, or the plan if the search is done.
+        The plan is empty if there isn't one.
+        """
+        return self.path
+
+    def estimate(self, node):
+        pass
+
+    def solved(self, node):
+        raise NotImplementedError
+
+    def children(self, node):
+        raise NotImplementedError
+
+
+class PlanSearch(Search):
+    """
+    Search forwards from the start memory until the goal is satisfied.
+
+    Nodes are keyed by the state of their simulated memory, so a state that
+    can be reached by different orderings of the same actions is only
+    expanded once.
+
+    heuristic is a callable that accepts the goal and a memory and returns
+    an estimate of the cost to satisfy the goal from there.  If it never
+    overestimates, the plan will be the cheapest one.  goal_heuristic is
+    used if one is not supplied.
+
+    The cost of each action is found with its calc_cost method.  Actions
+    that return a key from cost_key will only have their cost calculated
+    once per search for each key.
+
+    Only the builders returned by relevant_builders are used.
+    """
+
+    def __init__(self, parent, builders, start_action, start_memory, goal,
+                 heuristic=None, max_depth=None):
+        super(PlanSearch, self).__init__(max_depth)
+
+        if heuristic is None:
+            heuristic = goal_heuristic
+
+        self.parent = parent
+        self.builders = relevant_builders(builders, goal)
+        self.goal = goal
+        self.heuristic = heuristic
+        self.cache = {}
+
+        debug("[plan] solve %s starting from %s", goal, start_action)
+        debug("[plan] memory supplied is %s", start_memory)
+
+        self.push(PlanningNode(None, None, start_action, start_memory))
+
+    def estimate(self, node):
+        node.h = self.heuristic(self.goal, node.memory)
+
+    def solved(self, node):
+        # if our goal is satisfied, then stop
+        self.memory = node.memory
+        if self.goal.test(self.memory) >= 1.0:
+            debug("[plan] successful %s", node.action)
+            self.path = node.path()
+            return True
+
+        return False
+
+    def children(self, node):
+        return get_children(self.parent, node, self.builders, self.memory,
+                            self.cache)
+
+    def partial(self):
+        if self.done or self.best is None or self.best.parent is None:
+            return self.path
+        return self.best.path()
+
+
+def plan(parent, builders, start_action, start_memory, goal, heuristic=None,
+         max_nodes=None, max_time=None, max_depth=None):
     """
     Return a list of builders that could be called to satisfy the goal.
     Cannot duplicate builders in the plan
+
+    See PlanSearch for how the search is done.  If max_nodes or max_time
+    (in microseconds) are reached, then an empty list is returned, the same
+    as when there is no plan.  Use PlanSearch directly to continue the
+    search later, or to get the best partial plan from partial().
+    """
+
+    search = PlanSearch(parent, builders, start_action, start_memory, goal,
+                        heuristic, max_depth)
+    search.run(max_nodes, max_time)
+    return search.path
+
+plan.search = PlanSearch
+
+
+def touched(goals):
     """
+    Return the precepts that the goals will add to a memory when touched.
 
-    # the pushback is used to limit node access in the heap
-    pushback = None 
-    keyNode = PlanningNode(None, None, start_action, start_memory)
-    openlist = [(0, keyNode)]
-    closedlist = []
+    The goals are touched with a set, since all they can do to an empty
+    memory is add to it.
+    """
+    precepts = set()
+    for goal in goals:
+        goal.touch(precepts)
+    return frozenset(precepts)
+
+
+def replay(parent, steps, start_action, start_memory, goal):
+    """
+    Simulate a plan from the start memory and return it as plan() would.
 
-    debug("[plan] solve %s starting from %s", goal, start_action)
-    debug("[plan] memory supplied is %s", start_memory)
+    steps is a list of (builder, effects) in the order they will be done.
+    For each step the builder is asked for an action with the same effects
+    that can be started in the simulated memory.  If there isn't one, or the
+    goal is not satisfied at the end, then an empty list is returned.
+    """
 
-    success = False
-    while openlist or pushback:
+    memory = MemoryManager(start_memory)
+    path = [start_action]
 
-        # get the best node and remove it from the openlist
-        if pushback is None:
-            keyNode = heappop(openlist)[1]
+    for builder, effects in steps:
+        for action in builder(parent, memory):
+            if action.test(memory) >= 1.0 and touched(action.effects) == effects:
+                break
         else:
-            keyNode = heappushpop(openlist,
-                (pushback.g + pushback.h, pushback))[1]
-            pushback = None
-    
-        # if our goal is satisfied, then stop
-        if goal.test(keyNode.memory):
-            success = True
-            debug("[plan] successful %s", keyNode.action)
-            break
-
-        for child in get_children(parent, keyNode, builders):
-            if child in openlist:
-                possG = keyNode.g + child.cost
-                if (possG < child.g):
-                    child.parent = keyNode
-                    child.g = calcG(child)
-                    # TODO: update the h score
-            else:
-                # add node to our openlist, using pushpack if needed
-                if pushback is None:
-                    heappush(openlist, (child.g + child.h, child))
-                else:
-                    heappush(openlist, (pushback.g + pushback.h, pushback))
-                pushback = child
-
-    if success:
-        path = [keyNode.action]
-        while keyNode.parent is not None:
-            keyNode = keyNode.parent
-            path.append(keyNode.action)
+            return []
 
-        return path
+        action.touch(memory)
+        path.append(action)
 
-    else:
+    if goal.test(memory) < 1.0:
         return []
 
+    path.reverse()
+    return path
+
+
+class RegressionNode(object):
+    """
+    Node used when searching backwards from a goal.
+
+    Instead of a memory, the node holds the precepts that are still needed
+    before the actions after it can be done.
+    """
+
+    def __init__(self, parent, builder, effects, needed, mask=0, cost=0):
+        self.parent = parent
+        self.builder = builder
+        self.effects = effects
+        self.needed = needed
+        self.cost = cost
+        self.h = MIN_COST if needed else 0
+
+        if parent:
+            self.used = parent.used | mask
+            self.g = parent.g + cost
+            self.depth = parent.depth + 1
+        else:
+            self.used = mask
+            self.g = 0
+            self.depth = 0
+
+        self.key = (self.needed, self.used)
+
+    def steps(self):
+        """
+        Return the (builder, effects) of the plan in the order they are done.
+        """
+        node = self
+        steps = []
+        while node.parent is not None:
+            steps.append((node.builder, node.effects))
+            node = node.parent
+        return steps
+
+    def __repr__(self):
+        return "<RegressionNode: needs %s, cost: %s>" % \
+            (len(self.needed), self.cost)
+
+
+class BackwardSearch(Search):
+    """
+    Search backwards from the goal until nothing else is needed.
+
+    Only actions with effects that satisfy a precept that is still needed
+    are considered, so when an agent has many actions but the goal only
+    needs a few of them, this is much faster than searching forwards.
+
+    The builders are asked for actions once, from the start memory.  The
+    precepts that goals touch are used as the conditions, so actions must
+    list what they need in prereqs for them to be chained.  Every plan that
+    is found is checked with replay() before it is returned.
+
+    heuristic is accepted so it can be used in place of PlanSearch.  The
+    search uses the lowest action cost while anything is still needed.
+    """
+
+    def __init__(self, parent, builders, start_action, start_memory, goal,
+                 heuristic=None, max_depth=None):
+        super(BackwardSearch, self).__init__(max_depth)
+
+        self.parent = parent
+        self.start_action = start_action
+        self.start_memory = start_memory
+        self.goal = goal
+
+        if goal.test(start_memory) >= 1.0:
+            self.path = [start_action]
+            self.done = True
+            return
+
+        debug("[backward_plan] solve %s starting from %s", goal, start_action)
+
+        # index every action known by the precepts that it can satisfy
+        cache = {}
+        self.achievers = {}
+        builders = relevant_builders(builders, goal)
+        for index, builder in enumerate(builders):
+            mask = 1 << index
+            for action in builder(parent, start_memory):
+                effects = touched(action.effects)
+                required = touched(action.prereqs)
+                required = frozenset(p for p in required
+                                     if p not in start_memory)
+                cost = calc_cost(action, start_memory, cache)
+                step = (builder, effects, required, mask, cost)
+                for precept in effects:
+                    self.achievers.setdefault(precept, []).append(step)
+
+        needed = frozenset(p for p in touched([goal])
+                           if p not in start_memory)
+        self.push(RegressionNode(None, None, None, needed))
+
+    def solved(self, node):
+        if node.needed:
+            return False
+
+        # nothing else is needed, so check that the plan really works
+        path = replay(self.parent, node.steps(), self.start_action,
+                      self.start_memory, self.goal)
+        if path:
+            debug("[backward_plan] successful %s", path[0])
+            self.path = path
+            return True
 
+        return False
+
+    def children(self, node):
+        # only the actions that satisfy something that is needed
+        steps = set()
+        for precept in node.needed:
+            steps.update(self.achievers.get(precept, ()))
+
+        for builder, effects, required, mask, cost in steps:
+            if node.used & mask:
+                continue
+
+            needed = (node.needed - effects) | required
+            yield RegressionNode(node, builder, effects, needed, mask, cost)
+
+
+def backward_plan(parent, builders, start_action, start_memory, goal,
+                  heuristic=None, max_nodes=None, max_time=None,
+                  max_depth=None):
+    """
+    Return a plan like plan(), but search backwards from the goal.
+
+    See BackwardSearch for how the search is done.  A partial backward plan
+    cannot be started, so if max_nodes or max_time are reached, then an
+    empty list is returned.
+    """
+
+    search = BackwardSearch(parent, builders, start_action, start_memory,
+                            goal, heuristic, max_depth)
+    search.run(max_nodes, max_time)
+    return search.path
+
+backward_plan.search = BackwardSearch
+
+
+# stands in for the agent in precepts stored in a PlanCache, so that agents
+# with the same memories can share plans
+SELF = object()
+
+
+def swap(precepts, old, new):
+    """
+    Return the precepts with every field that is old replaced with new.
+    """
+    swapped = []
+    for precept in precepts:
+        if old in precept:
+            fields = [ new if i is old else i for i in precept ]
+            precept = precept.__class__(*fields)
+        swapped.append(precept)
+    return frozenset(swapped)
+
+
+class PlanCache(object):
+    """
+    Remember plans, keyed by the goal and the precepts in memory that the
+    plan depends on.
+
+    The precepts are found with relevance(), so if the builders declare what
+    they read, a plan is reused until something it depends on changes, or
+    the map of the agent's environment changes.  Failed searches are
+    remembered too.  The plans are stored as steps and
+    checked with replay() when they are used.
+
+    References to the agent are replaced in the keys and steps, so agents
+    of a class with the same builders can share one cache.  The least
+    recently used plan is dropped when there are more than size plans.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+
+    def __len__(self):
+        return len(self._plans)
+
+    def clear(self):
+        self._plans.clear()
+
+    def key(self, parent, builders, goal, memory):
+        """
+        Return the key for the plan that would satisfy goal from memory.
+        """
+        wanted = relevance(builders, goal)[1]
+
+        if wanted is None:
+            facts = memory
+        else:
+            facts = [ p for p in memory
+                      if not wanted.isdisjoint(precept_terms(p)) ]
+
+        conditions = touched([goal])
+        if not conditions:
+            conditions = goal
+
+        # builders can look at the map too, such as to find paths, so plans
+        # are only used again on the same map
+        environment = getattr(parent, 'environment', None)
+        grid_version = getattr(environment, 'grid_version', None)
+        if grid_version is not None:
+            grid_version = grid_version()
+
+        return (goal.__class__, swap(conditions, parent, SELF),
+                tuple( b.__class__ for b in builders ),
+                swap(facts, parent, SELF), grid_version)
+
+    def lookup(self, key, parent, builders, start_action, start_memory, goal):
+        """
+        Return the plan stored for key, remade for this agent and memory.
+
+        Returns None if there is no plan, or if it no longer works, and an
+        empty list if the search for the plan failed.
+        """
+
+        try:
+            steps = self._plans.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._plans[key] = steps
+        if steps is None:
+            self.hits += 1
+            return []
+
+        steps = [ (builders[i], swap(effects, SELF, parent))
+                  for i, effects in steps ]
+        path = replay(parent, steps, start_action, start_memory, goal)
+        if path:
+            self.hits += 1
+            return path
+
+        self.misses += 1
+        return None
+
+    def store(self, key, parent, builders, path):
+        """
+        Remember the plan (as returned by a planner) for key.
+        """
+
+        if path:
+            try:
+                steps = [ (builders.index(a.builder),
+                           swap(touched(a.effects), parent, SELF))
+                          for a in reversed(path[:-1]) ]
+            except ValueError:
+                # the action wasn't made by one of the builders
+                return
+        else:
+            steps = None
+
+        self._plans[key] = steps
+        if len(self._plans) > self.size:
+            self._plans.popitem(last=False)
+
+    def plan(self, planner, parent, builders, start_action, start_memory,
+             goal, **kwargs):
+        """
+        Return a plan from the cache, or use planner to make one.
+
+        The arguments are the same as plan(), and kwargs are passed to the
+        planner.  Do not pass max_nodes or max_time, since a search that
+        ran out would be stored as if it had failed.
+        """
+
+        key = self.key(parent, builders, goal, start_memory)
+        path = self.lookup(key, parent, builders, start_action, start_memory,
+                           goal)
+
+        if path is None:
+            path = planner(parent, builders, start_action, start_memory,
+                           goal, **kwargs)
+            self.store(key, parent, builders, path)
+
+        return path
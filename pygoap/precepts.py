@@ -5,11 +5,109 @@ Contains a set of useful precept types for use with an environment.
 from collections import namedtuple as nt
 
 
+
+# every type of precept, by name
+registry = {}
+
+
+def register(name, fields):
+    """
+    Create a new type of precept and return it.
+
+    Precepts are namedtuples, which have no __dict__, so they are already
+    as small as a tuple.  Strings in precepts, such as the names of
+    DatumPrecepts, should be interned where they are made, so that every
+    precept with the same name shares one string.  The returned class should
+    be assigned to a global with the same name, so that the precepts can be
+    pickled.
+    """
+
+    klass = nt(name, fields)
+    registry[name] = klass
+    return klass
+
+
 # used to remember where entities are
-PositionPrecept = nt('PositionPrecept', 'entity, position')
+PositionPrecept = register('PositionPrecept', 'entity, position')
 
 # used to remember what the time is
-TimePrecept = nt('TimePrecept', 'time')
+TimePrecept = register('TimePrecept', 'time')
 
 # used to remember a single piece of data
-DatumPrecept = nt('DatumPrecept', 'name, value')
+DatumPrecept = register('DatumPrecept', 'name, value')
+
+
+class PreceptCache(object):
+    """
+    Flyweights for precepts.
+
+    Calling the cache with a precept returns an identical precept that is
+    already in use, or remembers this one, so that precepts that are seen
+    over and over are only stored once.  Precepts are compared by their
+    type too, unlike tuples.
+
+    When more than size precepts are remembered, the cache is cleared.  The
+    cache keeps what is in the precepts alive until then, so make one for
+    something that lives as long as the things in its precepts.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._count = 0
+        self._precepts = {}         # type -> {precept: precept}
+
+    def __call__(self, precept):
+        try:
+            cache = self._precepts[precept.__class__]
+        except KeyError:
+            cache = self._precepts[precept.__class__] = {}
+
+        try:
+            found = cache[precept]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable precepts cannot be shared
+            return precept
+        else:
+            self.hits += 1
+            return found
+
+        self.misses += 1
+        if self._count >= self.size:
+            self.clear()
+            cache = self._precepts[precept.__class__] = {}
+
+        cache[precept] = precept
+        self._count += 1
+        return precept
+
+    def clear(self):
+        self._precepts.clear()
+        self._count = 0
+
+
+def precept_terms(precept):
+    """
+    Return the terms that describe a precept: its type, and also its name if
+    it is a DatumPrecept.  ActionBuilders use terms to declare what they read
+    and produce.
+    """
+    if isinstance(precept, DatumPrecept):
+        return (precept.__class__, precept.name)
+    return (precept.__class__,)
+
+
+def precept_key(precept):
+    """
+    Return the fact that a precept is about, or None.  In a keyed memory, a
+    precept replaces any other precept with the same key: a position is
+    about an entity, and a datum is about its name.
+    """
+    if isinstance(precept, PositionPrecept):
+        return (PositionPrecept, precept.entity)
+    if isinstance(precept, DatumPrecept):
+        return (DatumPrecept, precept.name)
+    return None
@@ -0,0 +1,67 @@
+"""
+A heap where the priority of an item can be changed.
+"""
+
+from heapq import heappush, heappop, heapify
+
+
+
+class PriorityTable(object):
+    """
+    Items kept in order of a key, the lowest first.  Each item is in the
+    table once, and pushing it again replaces its key.
+
+    Changing or removing an item leaves its old entry in the heap, where it
+    is skipped when it comes to the top.  Old entries are left in the heap
+    until there are too many.  Keys should be unique, such as by ending
+    with a counter, so that items are never compared.
+    """
+
+    def __init__(self):
+        self._heap = []             # (key, item)
+        self._entries = {}          # item -> its current entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, item):
+        return item in self._entries
+
+    def push(self, item, key):
+        entry = (key, item)
+        self._entries[item] = entry
+        heappush(self._heap, entry)
+
+        if len(self._heap) > len(self._entries) * 2:
+            self._heap = self._entries.values()
+            heapify(self._heap)
+
+    def remove(self, item):
+        self._entries.pop(item, None)
+
+    def clear(self):
+        self._heap = []
+        self._entries.clear()
+
+    def peek(self):
+        """
+        return the (key, item) with the lowest key, or None if empty
+        """
+        heap = self._heap
+        while heap:
+            entry = heap[0]
+            if self._entries.get(entry[1]) is entry:
+                return entry
+            heappop(heap)
+        return None
+
+    def pop(self):
+        """
+        remove and return the (key, item) with the lowest key
+        """
+        entry = self.peek()
+        if entry is None:
+            raise IndexError("pop from an empty PriorityTable")
+        heappop(self._heap)
+        del self._entries[entry[1]]
+        return entry
@@ -1,4 +1,6 @@
 from environment2d import XYEnvironment
+from pathfinding.astar import Grid
+from pathfinding.hierarchy import HierarchicalGrid
 import tmxloader
 from pygame import Surface
 
@@ -7,14 +9,25 @@ from pygame import Surface
 class TiledEnvironment(XYEnvironment):
     """
     Environment that can use Tiled Maps
+
+    if cluster_size is given, paths on the collision layer are found with
+    a HierarchicalGrid with clusters of that size, which is much faster on
+    big maps, but the paths are not always the shortest.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, collision_layer=None, cluster_size=None):
         self.filename = filename
         self.tiledmap = tmxloader.load_pygame(self.filename)
     
         super(TiledEnvironment, self).__init__()
 
+        # tiles in the collision layer cannot be walked through
+        if collision_layer is not None:
+            layer = self.tiledmap.tilelayers[collision_layer]
+            self.grid = Grid.from_rows(layer.data)
+            if cluster_size is not None:
+                self.grid = HierarchicalGrid(self.grid, cluster_size)
+
     def render(self, surface):
         # not going for effeciency here
 
@@ -51,6 +51,10 @@ def is_female(precept):
 
 # subclass the basic GoapAgent class to give them gender and names
 class Human(GoapAgent):
+
+    # only remember the last place that things were seen
+    keyed_memory = True
+
     def __init__(self, gender, name="welp"):
         super(Human, self).__init__()
         self.gender = gender